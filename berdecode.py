@@ -0,0 +1,221 @@
+# Minimal BER codec for SNMPv2c GET/GETBULK requests and their responses, enough
+# for the table walker to skip pysnmp's ASN.1 object model, plus SNMPv2-Trap
+# PDUs for the trap listener. decode_response() and decode_trap()
+# return native values: int for INTEGER, Counter32, Gauge32, TimeTicks and
+# Counter64, bytes for OCTET STRING, IpAddress and Opaque, a tuple for OIDs,
+# None for NULL and the sentinels below for the v2c exceptions.
+
+
+class SNMPException(object):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+NO_SUCH_OBJECT = SNMPException('noSuchObject')
+NO_SUCH_INSTANCE = SNMPException('noSuchInstance')
+END_OF_MIB_VIEW = SNMPException('endOfMibView')
+
+ERROR_STATUS = ('noError', 'tooBig', 'noSuchName', 'badValue', 'readOnly', 'genErr', 'noAccess', 'wrongType',
+                'wrongLength', 'wrongEncoding', 'wrongValue', 'noCreation', 'inconsistentValue',
+                'resourceUnavailable', 'commitFailed', 'undoFailed', 'authorizationError', 'notWritable',
+                'inconsistentName')
+
+SEQUENCE = 0x30
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+GET_REQUEST = 0xa0
+RESPONSE = 0xa2
+GET_BULK_REQUEST = 0xa5
+TRAP = 0xa7
+TIMETICKS = 0x43
+
+_UNSIGNED = frozenset((0x41, 0x42, 0x43, 0x46))  # Counter32, Gauge32, TimeTicks, Counter64
+_OCTETS = frozenset((OCTET_STRING, 0x40, 0x44))  # OCTET STRING, IpAddress, Opaque
+_EXCEPTIONS = {0x80: NO_SUCH_OBJECT, 0x81: NO_SUCH_INSTANCE, 0x82: END_OF_MIB_VIEW}
+
+
+def error_status_name(error_status):
+    if 0 <= error_status < len(ERROR_STATUS):
+        return ERROR_STATUS[error_status]
+    return str(error_status)
+
+
+# Encoding
+
+def _tlv(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return bytes((tag, length)) + content
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((tag, 0x80 | len(length_bytes))) + length_bytes + content
+
+
+def _integer(value):
+    return _tlv(INTEGER, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def encode_oid(oid):
+    if isinstance(oid, str):
+        oid = [int(x) for x in oid.strip('.').split('.')]
+    content = bytearray((oid[0] * 40 + oid[1],))
+    for sub_id in oid[2:]:
+        if sub_id < 0x80:
+            content.append(sub_id)
+            continue
+        chunk = []
+        while sub_id:
+            chunk.append(sub_id & 0x7f | 0x80)
+            sub_id >>= 7
+        chunk[0] &= 0x7f
+        content.extend(reversed(chunk))
+    return _tlv(OBJECT_IDENTIFIER, bytes(content))
+
+
+def _message(community, pdu_type, request_id, a, b, oids):
+    null = bytes((NULL, 0))
+    var_binds = b''.join(_tlv(SEQUENCE, encode_oid(oid) + null) for oid in oids)
+    pdu = _tlv(pdu_type, _integer(request_id) + _integer(a) + _integer(b) + _tlv(SEQUENCE, var_binds))
+    if isinstance(community, str):
+        community = community.encode()
+    return _tlv(SEQUENCE, _integer(1) + _tlv(OCTET_STRING, community) + pdu)
+
+
+def encode_get(community, request_id, oids):
+    return _message(community, GET_REQUEST, request_id, 0, 0, oids)
+
+
+def encode_get_bulk(community, request_id, non_repeaters, max_repetitions, oids):
+    return _message(community, GET_BULK_REQUEST, request_id, non_repeaters, max_repetitions, oids)
+
+
+def _value(value):
+    # int as INTEGER, bytes or str as OCTET STRING, a tuple as OBJECT IDENTIFIER, None as NULL.
+    if value is None:
+        return bytes((NULL, 0))
+    if isinstance(value, int):
+        return _integer(value)
+    if isinstance(value, tuple):
+        return encode_oid(value)
+    if isinstance(value, str):
+        value = value.encode()
+    return _tlv(OCTET_STRING, bytes(value))
+
+
+def encode_trap(community, request_id, uptime, trap_oid, var_binds=()):
+    # SNMPv2-Trap with sysUpTime.0 and snmpTrapOID.0 ahead of var_binds, a list of (oid, value).
+    if isinstance(trap_oid, str):
+        trap_oid = tuple(int(x) for x in trap_oid.strip('.').split('.'))
+    binds = [_tlv(SEQUENCE, encode_oid('1.3.6.1.2.1.1.3.0') +
+                  _tlv(TIMETICKS, uptime.to_bytes(uptime.bit_length() // 8 + 1, 'big'))),
+             _tlv(SEQUENCE, encode_oid('1.3.6.1.6.3.1.1.4.1.0') + encode_oid(trap_oid))]
+    binds.extend(_tlv(SEQUENCE, encode_oid(oid) + _value(value)) for oid, value in var_binds)
+    pdu = _tlv(TRAP, _integer(request_id) + _integer(0) + _integer(0) + _tlv(SEQUENCE, b''.join(binds)))
+    if isinstance(community, str):
+        community = community.encode()
+    return _tlv(SEQUENCE, _integer(1) + _tlv(OCTET_STRING, community) + pdu)
+
+
+# Decoding
+
+def _header(data, pos):
+    # (tag, content start, content end) of the TLV at pos.
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[pos:pos + size], 'big')
+        pos += size
+    return tag, pos, pos + length
+
+
+def decode_oid(content):
+    first = content[0]
+    if first < 80:
+        head = (first // 40, first % 40)
+    else:
+        head = (2, first - 80)
+    rest = content[1:]
+    if rest.isascii():
+        # Every sub-identifier below 128 is one byte, the common case.
+        return head + tuple(rest)
+    oid = list(head)
+    sub_id = 0
+    for byte in rest:
+        sub_id = (sub_id << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            oid.append(sub_id)
+            sub_id = 0
+    return tuple(oid)
+
+
+def decode_response(data):
+    """Decode a Response-PDU message.
+
+    Returns (request_id, error_status, error_index, var_binds) with var_binds
+    a list of (oid_tuple, value); raises ValueError on anything else.
+    """
+    return _decode(data, RESPONSE)[1:]
+
+
+def decode_trap(data):
+    # (community, request_id, var_binds) of an SNMPv2-Trap message; raises ValueError on anything else.
+    community, request_id, _, _, var_binds = _decode(data, TRAP)
+    return community, request_id, var_binds
+
+
+def _decode(data, pdu_type):
+    try:
+        tag, pos, end = _header(data, 0)
+        if tag != SEQUENCE:
+            raise ValueError('not an SNMP message')
+        if end > len(data):
+            raise IndexError
+        _, pos, end = _header(data, pos)  # version
+        _, pos, end = _header(data, end)  # community
+        community = data[pos:end]
+        tag, pos, end = _header(data, end)
+        if tag != pdu_type:
+            raise ValueError('unexpected PDU type 0x%02x' % tag)
+
+        header = []
+        for _ in range(3):
+            _, pos, end = _header(data, pos)
+            header.append(int.from_bytes(data[pos:end], 'big', signed=True))
+            pos = end
+        request_id, error_status, error_index = header
+
+        _, pos, list_end = _header(data, pos)
+        var_binds = []
+        append = var_binds.append
+        while pos < list_end:
+            _, pos, bind_end = _header(data, pos)
+            _, pos, end = _header(data, pos)
+            oid = decode_oid(data[pos:end])
+            tag, pos, end = _header(data, end)
+            if tag == INTEGER:
+                value = int.from_bytes(data[pos:end], 'big', signed=True)
+            elif tag in _UNSIGNED:
+                value = int.from_bytes(data[pos:end], 'big')
+            elif tag in _OCTETS:
+                value = data[pos:end]
+            elif tag == OBJECT_IDENTIFIER:
+                value = decode_oid(data[pos:end])
+            elif tag in _EXCEPTIONS:
+                value = _EXCEPTIONS[tag]
+            elif tag == NULL:
+                value = None
+            else:
+                raise ValueError('unsupported value type 0x%02x' % tag)
+            append((oid, value))
+            pos = bind_end
+    except IndexError:
+        raise ValueError('truncated SNMP message')
+    return community, request_id, error_status, error_index, var_binds
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from snmptable import CDP_UPLINK
+from snmptool import SNMPHelper, short_hostname
+
+logger = logging.getLogger("ICBC")
+
+SYS_NAME_OID = '1.3.6.1.2.1.1.5.0'
+
+
+def probe_hostname(snmp_helper):
+    # sysName alone, one GET, so a device already crawled through another address costs nothing more.
+    values, _ = snmp_helper.get_scalars([SYS_NAME_OID])
+    if SYS_NAME_OID not in values:
+        return 'Unknown'
+    return short_hostname(str(values[SYS_NAME_OID]))
+
+
+def probe_neighbors(snmp_helper):
+    if_index_dict = snmp_helper.get_if_index()
+    cdp_info = snmp_helper.get_cdp_info()
+
+    neighbors = []
+    for if_index, cdp_list in cdp_info.items():
+        for cdp in cdp_list:
+            neighbors.append(dict(local_port=if_index_dict.get(if_index, str(if_index)),
+                                  neighbor=cdp['neighbor'],
+                                  remote_port=cdp['remote_port'],
+                                  address=cdp['address'],
+                                  capabilities=cdp['capabilities']))
+    return neighbors
+
+
+async def crawl(seeds, community, timeout=5, retries=1, concurrency=32, max_depth=None, executor=None):
+    """Breadth-first CDP discovery starting from the seed addresses.
+
+    Returns (graph, unreachable): graph is {sysName: {ip, depth, neighbors}}
+    where each neighbor is {local_port, neighbor, remote_port, address,
+    capabilities}, and unreachable lists the addresses that did not answer.
+    Each address is asked for its sysName first and its tables are walked
+    only if no other address claimed that name, so a device is walked once.
+    Only switch and router neighbours are followed; phones and access
+    points would each cost a timeout.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    seen_ips = set()
+    graph = {}
+    claimed = set()  # sysNames being walked or walked
+    unreachable = []
+
+    for ip in seeds:
+        if ip not in seen_ips:
+            seen_ips.add(ip)
+            queue.put_nowait((ip, 0))
+
+    async def visit(ip, depth):
+        snmp_helper = SNMPHelper(ip, community, timeout=timeout, retries=retries)
+        hostname = None
+        try:
+            hostname = await loop.run_in_executor(executor, probe_hostname, snmp_helper)
+            if hostname in claimed:
+                logger.debug('%s: %s already crawled', ip, hostname)
+                return
+            claimed.add(hostname)
+            neighbors = await loop.run_in_executor(executor, probe_neighbors, snmp_helper)
+        except Exception as e:
+            logger.error('%s: CDP crawl failed: %s' % (ip, e))
+            unreachable.append(ip)
+            # Another address of the device may still answer.
+            claimed.discard(hostname)
+            return
+
+        graph[hostname] = dict(ip=ip, depth=depth, neighbors=neighbors)
+        logger.info("Discovered %s (%s) at depth %d", hostname, ip, depth)
+        if max_depth is not None and depth >= max_depth:
+            return
+        for neighbor in neighbors:
+            address = neighbor['address']
+            capabilities = neighbor['capabilities']
+            if capabilities is not None and not capabilities & CDP_UPLINK:
+                continue
+            if address and address not in seen_ips and neighbor['neighbor'] not in claimed:
+                seen_ips.add(address)
+                queue.put_nowait((address, depth + 1))
+
+    async def worker():
+        while True:
+            ip, depth = await queue.get()
+            try:
+                await visit(ip, depth)
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return graph, unreachable
+
+
+def graph_edges(graph):
+    # Unique (device, port, neighbor, neighbor_port) links, each reported once.
+    edges = set()
+    for hostname, device in graph.items():
+        for neighbor in device['neighbors']:
+            a = (hostname, neighbor['local_port'])
+            b = (neighbor['neighbor'], neighbor['remote_port'])
+            edges.add(min(a, b) + max(a, b))
+    return sorted(edges)
+
+
+def crawl_config(configs, concurrency=32, max_depth=None):
+    community = configs['snmp']['community']
+    retries = configs['snmp']['retries']
+    timeout = configs['snmp']['timeout']
+    seeds = [host for value_zone in configs['host'] for host in value_zone['gateway']]
+
+    async def run():
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return await crawl(seeds, community, timeout=timeout, retries=retries,
+                               concurrency=concurrency, max_depth=max_depth, executor=executor)
+
+    return asyncio.run(run())
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    with open(sys.argv[1] if len(sys.argv) > 1 else 'config.json') as f:
+        configs = json.load(f)
+
+    s = time.time()
+    graph, unreachable = crawl_config(configs)
+    print(json.dumps(dict(devices=graph, edges=graph_edges(graph), unreachable=unreachable), indent=2))
+    logger.info("Discovered %d devices in %.1fs", len(graph), time.time() - s)
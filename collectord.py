@@ -0,0 +1,333 @@
+import asyncio
+import heapq
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ifcounter import CounterPoller
+from snmpstore import SnapshotStore
+from snmptable import LocatorIndex, merge_arp
+from snmptool import device_poller
+from snmptrap import TrapListener
+
+logger = logging.getLogger("ICBC")
+
+# Seconds between runs of each task, overridden by "collector": {"intervals": {...}} in config.json.
+# tables is one IncrementalPoller.poll(): a GET of the device facts that re-walks if_index, if_ip,
+# cdp_info and vlan_info only when they changed, and in full every `full_every` seconds.
+# A task with interval 0 is not scheduled.
+INTERVALS = {
+    'tables': 300,
+    'arp': 300,
+    'fdb': 300,
+    'counters': 0,
+}
+FULL_EVERY = 3600
+JITTER = 0.1
+
+
+class DeviceState(object):
+    # Everything kept warm for one host between cycles.
+
+    def __init__(self, host, zone, poller, gateway, access_switch):
+        self.host = host
+        self.zone = zone
+        self.poller = poller
+        self.gateway = gateway
+        self.access_switch = access_switch
+        self.counters = None
+        self.arp = None
+        self.mac_table = None
+        self.lock = threading.Lock()  # serializes poller.poll()
+        self.running = set()
+        self.last_run = {}
+        self.errors = {}
+
+    @property
+    def snmp_helper(self):
+        return self.poller.snmp_helper
+
+    def tasks(self):
+        tasks = ['tables', 'arp', 'counters']
+        if self.access_switch:
+            tasks.append('fdb')
+        return tasks
+
+
+class Collector(object):
+    """Long-running collection of the config.json fleet.
+
+    Every device gets one DeviceState, whose IncrementalPoller and SNMP
+    helper live as long as the collector, and one schedule entry per task.
+    Each run of a task is followed by the next one interval later, plus or
+    minus `jitter` of it, and the first runs are spread over a whole
+    interval, so devices drift apart instead of being walked all at once. A
+    task still running when it comes due again is skipped for that round.
+    Results go to the LocatorIndex in self.locator and, when a store is
+    given, to the SnapshotStore under one cycle id per `cycle` seconds;
+    slow tables are stored in the cycles they were re-walked in.
+
+    With trap_port, a TrapListener applies MAC notification and link traps
+    to the locator between walks, and the fdb interval can be raised to
+    a periodic reconciliation.
+    """
+
+    def __init__(self, configs, store=None, intervals=None, full_every=FULL_EVERY, jitter=JITTER, concurrency=32,
+                 vlan_concurrency=4, cycle=None, trap_port=None):
+        community = configs['snmp']['community']
+        retries = configs['snmp']['retries']
+        timeout = configs['snmp']['timeout']
+
+        self.intervals = dict(INTERVALS, **(intervals or {}))
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.vlan_concurrency = vlan_concurrency
+        self.store = store
+        self.locator = LocatorIndex()
+        if cycle is None:
+            # Short enough that no task runs twice for a device within one cycle.
+            cycle = min([x for x in self.intervals.values() if x] or [300]) * (1 - jitter)
+        self.cycle = cycle
+        self._cycle_id = None
+        self._cycle_end = 0
+        self._lock = threading.Lock()
+        self._stopping = None
+        self.community = community
+        self.trap_port = trap_port
+        self.trap_listener = None
+        # Bridge port maps missing for traps are walked here, off the listener's thread.
+        self._port_refresh = ThreadPoolExecutor(max_workers=4, thread_name_prefix='bridge-ports')
+        self._port_refresh_pending = set()
+
+        self.devices = {}
+        for value_zone in configs['host']:
+            zone = value_zone.get("zone", "")
+            gateway_list = value_zone['gateway']
+            access_switch_list = value_zone['access_switch']
+            for host in dict.fromkeys(gateway_list + access_switch_list):
+                gateway = host in gateway_list
+                access_switch = host in access_switch_list
+                poller = device_poller(host, community, timeout, retries, gateway, access_switch)
+                if self.intervals['tables']:
+                    poller.full_every = max(1, int(round(full_every / float(self.intervals['tables']))))
+                self.devices[host] = DeviceState(host, zone, poller, gateway, access_switch)
+
+    def _next_due(self, due, interval):
+        return due + interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def resolve_port(self, host, vlan_id, bridge_port):
+        """dot1dBasePort -> ifIndex for the trap listener, from the device's cached bridge port maps.
+
+        A port the cache lacks gives None and queues a walk of the VLAN's map
+        in the background, once per (host, vlan) at a time, so the listener
+        never waits on SNMP; the MACs of that trap are dropped and later ones
+        resolve, the next fdb run catching up on the rest.
+        """
+        state = self.devices.get(host)
+        if state is None:
+            return None
+        vlan = int(vlan_id)
+        if_index = state.snmp_helper.cached_bridge_port_if_index(bridge_port, vlan)
+        if if_index is None:
+            with self._lock:
+                if (host, vlan) in self._port_refresh_pending:
+                    return None
+                self._port_refresh_pending.add((host, vlan))
+            self._port_refresh.submit(self._refresh_ports, state, vlan, bridge_port)
+        return if_index
+
+    def _refresh_ports(self, state, vlan, bridge_port):
+        try:
+            state.snmp_helper.bridge_port_if_index(bridge_port, vlan)
+        except Exception as e:
+            logger.error('%s: bridge port map of Vlan%s failed: %s' % (state.host, vlan, e))
+        finally:
+            with self._lock:
+                self._port_refresh_pending.discard((state.host, vlan))
+
+    def arp_interfaces(self, state):
+        """ifIndexes to walk ARP on, None for the whole table.
+
+        A gateway skips the VLAN interfaces it is HSRP standby on, whose ARP
+        entries the active peer has too; the HSRP state is re-read every run,
+        a walk of one row per group, so a failover is followed at the next run.
+        """
+        if not state.gateway:
+            return None
+        standby = set(state.snmp_helper.get_hsrp_standby_interfaces())
+        if_ip = state.poller.tables.get('if_ip')
+        if not standby or not if_ip:
+            return None
+        if_index_list = sorted(set(if_ip) - standby)
+        logger.debug('%s: HSRP standby on %d interfaces, ARP walked on %d', state.host, len(standby),
+                     len(if_index_list))
+        return if_index_list
+
+    def zone_arp(self, zone):
+        # One de-duplicated ArpTable of the last ARP walks of a zone's devices, gateways first.
+        states = sorted((x for x in self.devices.values() if x.zone == zone and x.arp is not None),
+                        key=lambda x: not x.gateway)
+        return merge_arp([x.arp for x in states])
+
+    def cycle_id(self):
+        # The store cycle results are written under, a new one every self.cycle seconds.
+        with self._lock:
+            now = time.time()
+            if now >= self._cycle_end:
+                if self._cycle_id is not None:
+                    self.store.finish_cycle(self._cycle_id)
+                self._cycle_id = self.store.begin_cycle(now)
+                self._cycle_end = now + self.cycle
+            return self._cycle_id
+
+    def run_task(self, state, task):
+        # Run one task of one device; called on the collector's threads.
+        poller = state.poller
+        snmp_helper = state.snmp_helper
+        with state.lock:
+            if task != 'tables' and any(x not in poller.tables for x in poller.table_names):
+                # The other tasks need the interface and VLAN lists of a first successful poll.
+                poller.poll()
+
+        device = dict(host=state.host, hostname=snmp_helper.get_hostname(), facts=poller.facts,
+                      if_index=poller.tables.get('if_index', {}))
+        if task == 'tables':
+            with state.lock:
+                changes = poller.poll()
+            device['facts'] = poller.facts
+            for name in changes:
+                device[name] = poller.tables[name]
+            if changes:
+                logger.info('%s: re-walked %s', state.host, ', '.join(sorted(changes)))
+        elif task == 'arp':
+            state.arp = device['arp'] = snmp_helper.get_arp_table(self.arp_interfaces(state))
+            with self._lock:
+                self.locator.update_arp(state.host, state.arp)
+        elif task == 'fdb':
+            vlans = list(poller.tables.get('vlan_info', {}))
+            state.mac_table = device['mac_if_info'] = snmp_helper.get_mac_table(vlans,
+                                                                                concurrency=self.vlan_concurrency)
+            with self._lock:
+                self.locator.update_switch(state.host, state.mac_table, if_index_dict=device['if_index'],
+                                           cdp_info=poller.tables.get('cdp_info'))
+        elif task == 'counters':
+            if state.counters is None:
+                state.counters = CounterPoller(snmp_helper)
+            state.counters.sample()
+            return
+
+        if self.store is not None:
+            self.store.write_device(self.cycle_id(), state.host, device, zone=state.zone)
+
+    async def run(self, until=None):
+        """Schedule and run tasks until stop() is called or `until` (a time.time()) is reached."""
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        running = set()
+
+        now = time.time()
+        schedule = []
+        for state in self.devices.values():
+            for task in state.tasks():
+                interval = self.intervals[task]
+                if interval:
+                    heapq.heappush(schedule, (now + random.uniform(0, interval), state.host, task))
+
+        async def execute(state, task):
+            async with semaphore:
+                s = time.time()
+                try:
+                    await loop.run_in_executor(executor, self.run_task, state, task)
+                    state.errors.pop(task, None)
+                except Exception as e:
+                    logger.error('%s: %s failed: %s' % (state.host, task, e))
+                    state.errors[task] = str(e)
+                finally:
+                    state.running.discard(task)
+                state.last_run[task] = time.time()
+                logger.debug("%s: %s in %.2fs", state.host, task, time.time() - s)
+
+        if self.trap_port is not None:
+            self.trap_listener = TrapListener(self.locator, resolve_port=self.resolve_port, community=self.community,
+                                              port=self.trap_port, lock=self._lock).start()
+            logger.info('Listening for traps on port %d', self.trap_listener.port)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='collector') as executor:
+            while schedule and not self._stopping.is_set():
+                due, host, task = schedule[0]
+                delay = due - time.time()
+                if until is not None:
+                    delay = min(delay, until - time.time())
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._stopping.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    if until is not None and time.time() >= until:
+                        break
+                    continue
+
+                heapq.heapreplace(schedule, (self._next_due(due, self.intervals[task]), host, task))
+                state = self.devices[host]
+                if task in state.running:
+                    logger.warning('%s: %s still running, skipped', host, task)
+                    continue
+                state.running.add(task)
+                future = asyncio.ensure_future(execute(state, task))
+                running.add(future)
+                future.add_done_callback(running.discard)
+
+            if running:
+                await asyncio.gather(*running)
+
+        if self.trap_listener is not None:
+            self.trap_listener.stop()
+
+        if self.store is not None and self._cycle_id is not None:
+            self.store.finish_cycle(self._cycle_id)
+            self._cycle_id = None
+            self._cycle_end = 0
+
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    def status(self):
+        # {host: {zone, last_run, errors}} for monitoring.
+        return dict((host, dict(zone=state.zone, last_run=dict(state.last_run), errors=dict(state.errors)))
+                    for host, state in self.devices.items())
+
+
+def collector_from_config(configs):
+    # Build a Collector from config.json, with its optional "collector" section.
+    options = configs.get('collector', {})
+    store = SnapshotStore(options['db']) if options.get('db') else None
+    return Collector(configs, store=store,
+                     intervals=options.get('intervals'),
+                     full_every=options.get('full_every', FULL_EVERY),
+                     jitter=options.get('jitter', JITTER),
+                     concurrency=options.get('concurrency', 32),
+                     vlan_concurrency=options.get('vlan_concurrency', 4),
+                     cycle=options.get('cycle'),
+                     trap_port=options.get('trap_port'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    with open(sys.argv[1] if len(sys.argv) > 1 else 'config.json') as f:
+        configs = json.load(f)
+
+    collector = collector_from_config(configs)
+    logger.info('Collecting %d devices', len(collector.devices))
+    try:
+        asyncio.run(collector.run())
+    except KeyboardInterrupt:
+        logger.info('Stopped.')
+    finally:
+        if collector.store is not None:
+            collector.store.close()
@@ -5,17 +5,28 @@ import pysnmp.proto.rfc1902 as rfc1902
 
 import time
 
+from oidcodec import FDB_INDEX, IP_ADDR_INDEX, QBRIDGE_FDB_INDEX, QBRIDGE_VLAN_INDEX, parse_oid
+from snmppool import engine_pool
+from snmptable import int_to_ip, int_to_mac
+
 TARGET = '10.0.0.8'
 
-def snmp_walk(host, oid, format='str', strip_prefix=True, community='public'):
-    res = []
+CONTEXT_DATA = hlapi.ContextData()
+
+def snmp_walk(host, oid, format='str', strip_prefix=True, community='public', port=161):
+    return dict(snmp_walk_iter(host, oid, format=format, strip_prefix=strip_prefix, community=community, port=port))
+
+
+def _walk_var_binds(host, oid, community='public', max_repetitions=25, port=161):
+    # Yield the raw pysnmp (name, value) pairs of one subtree as each GETBULK response arrives.
     for (errorIndication,
          errorStatus,
          errorIndex,
-         varBinds) in hlapi.nextCmd(hlapi.SnmpEngine(),
-                                    hlapi.CommunityData(community),
-                                    hlapi.UdpTransportTarget((host, 161), timeout=4.0, retries=3),
-                                    hlapi.ContextData(),
+         varBinds) in hlapi.bulkCmd(engine_pool.snmp_engine(),
+                                    engine_pool.community_data(community),
+                                    engine_pool.transport_target(host, port, timeout=4.0, retries=3),
+                                    CONTEXT_DATA,
+                                    0, max_repetitions,
                                     hlapi.ObjectType(hlapi.ObjectIdentity(oid)),
                                     lookupMib=False,
                                     lexicographicMode=False):
@@ -24,77 +35,109 @@ def snmp_walk(host, oid, format='str', strip_prefix=True, community='public'):
         elif errorStatus:
             raise ConnectionError('errorStatus: %s at %s' % (errorStatus.prettyPrint(),
                                                              errorIndex and varBinds[int(errorIndex) - 1][0] or '?'))
+        for var_bind in varBinds:
+            yield var_bind
+
+
+def snmp_walk_iter(host, oid, format='str', strip_prefix=True, community='public', max_repetitions=25, port=161):
+    # Yield (oid, value) pairs as each GETBULK response arrives instead of buffering the table.
+    for k, v in _walk_var_binds(host, oid, community=community, max_repetitions=max_repetitions, port=port):
+        if strip_prefix:
+            k = str(k)[len(str(oid)) + 1:]
+        if isinstance(v, rfc1902.Integer):
+            yield str(k), int(v)
         else:
-            for x in varBinds:
-                k, v = x
-                if strip_prefix:
-                    k = str(k)[len(str(oid)) + 1:]
-                if isinstance(v, rfc1902.Integer):
-                    res.append((str(k), int(v)))
-                else:
-                    if format == 'numbers':
-                        res.append((str(k), v.asNumbers()))
-                    elif format == 'hex':
-                        res.append((str(k), v.asOctets().hex()))
-                    elif format == 'raw':
-                        res.append((str(k), v))
-                    elif format == 'bin':
-                        res.append((str(k), v.asOctets()))
-                    elif format == 'int':
-                        res.append((str(k), int(v)))
-                    elif format == 'preview':
-                        res.append((str(k), str(v)))
-                    elif format == 'any':
-                        try:
-                            res.append((str(k), v.asOctets().decode('utf-8')))
-                        except UnicodeDecodeError:
-                            res.append((str(k), '0x' + v.asOctets().hex()))
-                    elif format == 'str':
-                        res.append((str(k), v.asOctets().decode(v.encoding)))
-                    else:
-                        assert False, "Unknown format for walk()."
-    res = {a: b for a, b in res}
-    return res
+            if format == 'numbers':
+                yield str(k), v.asNumbers()
+            elif format == 'hex':
+                yield str(k), v.asOctets().hex()
+            elif format == 'raw':
+                yield str(k), v
+            elif format == 'bin':
+                yield str(k), v.asOctets()
+            elif format == 'int':
+                yield str(k), int(v)
+            elif format == 'preview':
+                yield str(k), str(v)
+            elif format == 'any':
+                try:
+                    value = v.asOctets().decode('utf-8')
+                except UnicodeDecodeError:
+                    value = '0x' + v.asOctets().hex()
+                yield str(k), value
+            elif format == 'str':
+                yield str(k), v.asOctets().decode(v.encoding)
+            else:
+                assert False, "Unknown format for walk()."
 
 
 def split_numbers(oid):
-    return [int(x) for x in oid.split('.')]
+    return list(parse_oid(oid))
 
 
 def read_ipv4_from_oid_tail(oid, with_len=True):
-    parts = [int(x) for x in oid.split('.')]
+    parts = parse_oid(oid)
     if with_len:
         assert (parts[-5] == 4)  # number of elements
-    return '.'.join([str(x) for x in parts[-4:]])
+    try:
+        return int_to_ip(IP_ADDR_INDEX.decode(parts[-4:])[0])
+    except ValueError:
+        # Not an address, e.g. the bridge port and ifIndex keys of __main__: the tail as it is.
+        return '.'.join(map(str, parts[-4:]))
 
 
 def read_bid_from_oid_tail(oid, with_len=True):
-    parts = [int(x) for x in oid.split('.')]
+    parts = parse_oid(oid)
     if with_len:
-        assert (parts[-5] == 1)  # number of elements
-    return '.'.join([str(x) for x in parts[-1:]])
+        assert (parts[-2] == 1)  # number of elements
+    return str(parts[-1])
 
 
 def read_mac_from_oid_tail(oid, with_len=True):
-    parts = [int(x) for x in oid.split('.')]
+    parts = parse_oid(oid)
     if with_len:
-        assert (parts[-5] == 6)  # number of elements
-    return '.'.join([str(x) for x in parts[-6:]])
+        assert (parts[-7] == 6)  # number of elements
+    return '.'.join(map(str, parts[-6:]))
+
+
+def _walk_index_column(host, oid, community='public', port=161):
+    # Return ([index suffix], [int value]) of one integer column, indexes left as tuples for oidcodec.
+    prefix_len = len(parse_oid(oid))
+    indexes = []
+    values = []
+    for name, value in _walk_var_binds(host, oid, community=community, port=port):
+        indexes.append(tuple(name)[prefix_len:])
+        values.append(int(value))
+    return indexes, values
+
+
+def read_fdb(host, community='public', port=161):
+    # Return {(vlan, mac): bid}, from one Q-BRIDGE dot1qTpFdbPort walk when the
+    # device has it, else from BRIDGE-MIB dot1dTpFdbPort (vlan None). mac is the
+    # dotted decimal OID form machex() takes. Q-BRIDGE FDB ids are mapped to
+    # VLANs by dot1qVlanFdbId, the lowest VLAN of a shared FDB standing for it.
+    indexes, bids = _walk_index_column(host, '1.3.6.1.2.1.17.7.1.2.2.1.2', community=community, port=port)
+    if indexes:
+        columns = QBRIDGE_FDB_INDEX.decode_columns(indexes)
+        vlan_indexes, fdb_ids = _walk_index_column(host, '1.3.6.1.2.1.17.7.1.4.2.1.3', community=community,
+                                                   port=port)
+        fdb_vlans = {}
+        for vlan, fdb_id in zip(QBRIDGE_VLAN_INDEX.decode_columns(vlan_indexes)['vlan'], fdb_ids):
+            fdb_vlans[fdb_id] = min(vlan, fdb_vlans.get(fdb_id, vlan))
+        vlans = [fdb_vlans.get(x, x) for x in columns['fdb_id']]
+    else:
+        indexes, bids = _walk_index_column(host, '1.3.6.1.2.1.17.4.3.1.2', community=community, port=port)
+        columns = FDB_INDEX.decode_columns(indexes)
+        vlans = [None] * len(indexes)
+
+    fdb = {}
+    for vlan, mac, bid in zip(vlans, columns['mac'], bids):
+        fdb[(vlan, '.'.join(map(str, mac.to_bytes(6, 'big'))))] = bid
+    return fdb
 
 
 def machex(getvar):
-    macs = getvar.split('.')
-    i = 0
-    ma = []
-    for x in range(0, 6):
-        maca = macs[i]
-        if len(maca) == 1:
-            a = hex(int(maca)).replace("x", "")
-        else:
-            a = hex(int(maca))[2:]
-        ma.append(a)
-        i = i + 1
-    return ma[0] + ":" + ma[1] + ":" + ma[2] + ":" + ma[3] + ":" + ma[4] + ":" + ma[5]
+    return int_to_mac(FDB_INDEX.decode(parse_oid(getvar))[0])
 
 
 if __name__ == "__main__":
@@ -143,12 +186,10 @@ if __name__ == "__main__":
 
     # Read dot1qTpFdbPort table
     print(" - Reading device dot1qTpFdbPort table...", file=sys.stderr)
-    # dot1qTpFdbPort = snmp_walk(TARGET, '1.3.6.1.2.1.17.4.3.1.2', 'int', community='public')
-    # dot1qTpFdbPort = snmp_walk(TARGET, '1.3.6.1.2.1.17.4.3.1.2', 'int', community='public')
-    dot1qTpFdbPort = snmp_walk(TARGET, '1.3.6.1.2.1.17.4.3.1.2', 'int', community='public')
+    dot1qTpFdbPort = read_fdb(TARGET, community='public')
     dot1qTpFdb = {}
-    for mac, bid in dot1qTpFdbPort.items():
-        macdec = read_mac_from_oid_tail(mac, with_len=False)
+    for (vlan, macdec), bid in dot1qTpFdbPort.items():
+        print('vlan=', vlan)
         print('machex=', machex(macdec))
         print('bid=', bid)
         dot1qTpFdb[machex(macdec)] = str(bid)
@@ -0,0 +1,196 @@
+import array
+import logging
+import math
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from snmptool import walk_executor
+
+logger = logging.getLogger("ICBC")
+
+# (name, column, counter bits) sampled for every interface, walked in lock step by ifIndex.
+COUNTERS = (
+    ('in_octets', '1.3.6.1.2.1.31.1.1.1.6', 64),  # ifHCInOctets
+    ('out_octets', '1.3.6.1.2.1.31.1.1.1.10', 64),  # ifHCOutOctets
+    ('in_errors', '1.3.6.1.2.1.2.2.1.14', 32),  # ifInErrors
+    ('out_errors', '1.3.6.1.2.1.2.2.1.20', 32),  # ifOutErrors
+    ('in_discards', '1.3.6.1.2.1.2.2.1.13', 32),  # ifInDiscards
+    ('out_discards', '1.3.6.1.2.1.2.2.1.19', 32),  # ifOutDiscards
+)
+IF_HIGH_SPEED_OID = '1.3.6.1.2.1.31.1.1.1.15'  # ifHighSpeed, Mbit/s
+
+
+class CounterRing(object):
+    """The last `size` counter samples of one device's interfaces.
+
+    Every counter is one flat array.array('Q') of size * ports values, slot
+    major, plus an array('B') marking which values the agent returned, so a
+    sample is a few slice assignments and no per-port objects. rates()
+    compares two slots with wrap-aware unsigned arithmetic, vectorized with
+    NumPy when it is installed.
+    """
+
+    def __init__(self, if_indexes, size=60):
+        self.if_index = array.array('I', if_indexes)
+        self.positions = dict((x, i) for i, x in enumerate(self.if_index))
+        self.size = size
+        self.ports = len(self.if_index)
+        self.times = array.array('d', [0.0] * size)
+        self.values = dict((name, array.array('Q', bytes(8 * size * self.ports))) for name, _, _ in COUNTERS)
+        self.valid = dict((name, array.array('B', bytes(size * self.ports))) for name, _, _ in COUNTERS)
+        self.speed = array.array('I', bytes(4 * self.ports))
+        self.count = 0
+        self.slot = -1
+
+    def append(self, timestamp, columns, valid):
+        # columns and valid map each counter name to one value per port, in self.if_index order.
+        self.slot = (self.slot + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.times[self.slot] = timestamp
+        start = self.slot * self.ports
+        for name, _, _ in COUNTERS:
+            self.values[name][start:start + self.ports] = columns[name]
+            self.valid[name][start:start + self.ports] = valid[name]
+
+    def _slot(self, age):
+        # Slot of the sample `age` samples before the newest one.
+        return (self.slot - age) % self.size
+
+    def sample(self, name, age=0):
+        start = self._slot(age) * self.ports
+        values = self.values[name]
+        if numpy is not None:
+            return numpy.frombuffer(values, dtype=numpy.uint64)[start:start + self.ports]
+        return values[start:start + self.ports]
+
+    def rates(self, window=1):
+        """Per-second rate of every counter over the last `window` intervals.
+
+        Returns {name: array('d')} in self.if_index order, NaN for ports the
+        agent did not answer for in either sample and for 64-bit counters that
+        went back (a reset; they cannot wrap in practice). 32-bit counters
+        are taken to have wrapped. None until there are window + 1 samples.
+        """
+        if self.count <= window:
+            return None
+        new_slot = self._slot(0)
+        old_slot = self._slot(window)
+        elapsed = self.times[new_slot] - self.times[old_slot]
+        if elapsed <= 0:
+            return None
+
+        result = {}
+        new_start = new_slot * self.ports
+        old_start = old_slot * self.ports
+        for name, _, bits in COUNTERS:
+            values = self.values[name]
+            valid = self.valid[name]
+            if numpy is not None:
+                all_values = numpy.frombuffer(values, dtype=numpy.uint64)
+                all_valid = numpy.frombuffer(valid, dtype=numpy.uint8)
+                new = all_values[new_start:new_start + self.ports]
+                old = all_values[old_start:old_start + self.ports]
+                delta = new - old  # wraps modulo 2 ** 64
+                if bits < 64:
+                    delta &= numpy.uint64((1 << bits) - 1)
+                rate = delta.astype(numpy.float64) / elapsed
+                ok = (all_valid[new_start:new_start + self.ports] & all_valid[old_start:old_start + self.ports]) > 0
+                if bits == 64:
+                    ok &= new >= old
+                rate[~ok] = numpy.nan
+                result[name] = array.array('d', rate.tobytes())
+            else:
+                mask = (1 << bits) - 1
+                rate = array.array('d', [math.nan] * self.ports)
+                for i in range(self.ports):
+                    if valid[new_start + i] and valid[old_start + i]:
+                        new = values[new_start + i]
+                        old = values[old_start + i]
+                        if bits < 64 or new >= old:
+                            rate[i] = ((new - old) & mask) / elapsed
+                result[name] = rate
+        return result
+
+    def utilization(self, window=1):
+        # {in, out: array('d')} of octet rates as a fraction of ifHighSpeed, NaN where the speed is 0.
+        rates = self.rates(window)
+        if rates is None:
+            return None
+        result = {}
+        for direction in ('in', 'out'):
+            octets = rates['%s_octets' % direction]
+            if numpy is not None:
+                speed = numpy.frombuffer(self.speed, dtype=numpy.uint32).astype(numpy.float64) * 1e6
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    fraction = numpy.frombuffer(octets, dtype=numpy.float64) * 8 / speed
+                fraction[speed == 0] = numpy.nan
+                result[direction] = array.array('d', fraction.tobytes())
+            else:
+                result[direction] = array.array('d', [octets[i] * 8 / (self.speed[i] * 1e6) if self.speed[i]
+                                                      else math.nan for i in range(self.ports)])
+        return result
+
+
+class CounterPoller(object):
+    """Sample one device's interface counters into a CounterRing.
+
+    Each sample() is one lock-step walk of the COUNTERS columns and
+    ifHighSpeed, with the helper's lean path by default so counters arrive as
+    plain ints. The ring is started over when the set of interfaces changes.
+    """
+
+    def __init__(self, snmp_helper, size=60, lean=True):
+        self.snmp_helper = snmp_helper
+        self.size = size
+        self.lean = lean
+        self.ring = None
+
+    def sample(self):
+        columns = [oid for _, oid, _ in COUNTERS] + [IF_HIGH_SPEED_OID]
+        s = time.time()
+        rows = self.snmp_helper.walk_table(columns, lean=self.lean)
+        timestamp = (s + time.time()) / 2
+
+        if_indexes = [index[0] for index, _ in rows]
+        if self.ring is None or list(self.ring.if_index) != if_indexes:
+            if self.ring is not None:
+                logger.info('%s: interfaces changed, counter history dropped', self.snmp_helper.ip)
+            self.ring = CounterRing(if_indexes, self.size)
+
+        ring = self.ring
+        values = list(zip(*[row for _, row in rows])) if rows else [()] * (len(COUNTERS) + 1)
+        counters = {}
+        valid = {}
+        for (name, _, _), column in zip(COUNTERS, values):
+            counters[name] = array.array('Q', [0 if x is None else int(x) for x in column])
+            valid[name] = array.array('B', [x is not None for x in column])
+        ring.speed = array.array('I', [0 if x is None else int(x) for x in values[-1]])
+        ring.append(timestamp, counters, valid)
+        return ring
+
+
+def sample_all(pollers, concurrency=32):
+    # One sample of every poller, `concurrency` devices at a time on the shared walk threads.
+    # Returns the rings in poller order, None for devices that failed.
+    pending = list(reversed(list(enumerate(pollers))))
+    rings = [None] * len(pending)
+
+    def sample():
+        while True:
+            try:
+                i, poller = pending.pop()
+            except IndexError:
+                return
+            try:
+                rings[i] = poller.sample()
+            except Exception as e:
+                logger.error('%s: counter sample failed: %s' % (poller.snmp_helper.ip, e))
+
+    futures = [walk_executor().submit(sample) for _ in range(min(concurrency, len(pending)))]
+    for future in futures:
+        future.result()
+    return rings
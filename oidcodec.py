@@ -0,0 +1,111 @@
+import array
+
+# Index field kinds. IPv4 and MAC decode to unsigned integers (see snmptable for
+# formatting), octet strings to bytes and InetAddress to (address_type, bytes).
+INTEGER = 'int'
+IPV4 = 'ipv4'
+MAC = 'mac'
+OCTETS = 'octets'  # length-prefixed OCTET STRING
+IMPLIED = 'implied'  # IMPLIED OCTET STRING, the rest of the index
+INET_ADDRESS = 'inet_address'  # InetAddressType followed by a length-prefixed InetAddress
+
+_WIDTHS = {INTEGER: 1, IPV4: 4, MAC: 6}
+_TYPECODES = {INTEGER: 'I', IPV4: 'I', MAC: 'Q'}
+
+
+def _octets(suffix, start, end):
+    if end > len(suffix):
+        raise ValueError('index %s too short' % (suffix,))
+    return bytes(suffix[start:end])
+
+
+class IndexSpec(object):
+    """Declarative layout of a table's OID index.
+
+    e.g. IndexSpec(('if_index', INTEGER), ('ip', IPV4)) for ipNetToMediaTable.
+    decode() turns one index suffix into a tuple of field values,
+    decode_columns() a whole list of them into {field: column}, with
+    array.array columns for the integer kinds. Fixed-width specs decode each
+    column in one pass; indexes with variable-length strings are decoded row by
+    row. Suffixes that do not match the spec raise ValueError.
+    """
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.names = tuple(name for name, _ in fields)
+        if all(kind in _WIDTHS for _, kind in fields):
+            self.width = sum(_WIDTHS[kind] for _, kind in fields)
+        else:
+            self.width = None
+
+    def decode(self, suffix):
+        values = []
+        pos = 0
+        for _, kind in self.fields:
+            if kind == INTEGER:
+                if pos >= len(suffix):
+                    raise ValueError('index %s too short' % (suffix,))
+                values.append(suffix[pos])
+                pos += 1
+            elif kind in (IPV4, MAC):
+                end = pos + _WIDTHS[kind]
+                values.append(int.from_bytes(_octets(suffix, pos, end), 'big'))
+                pos = end
+            elif kind == OCTETS:
+                if pos >= len(suffix):
+                    raise ValueError('index %s too short' % (suffix,))
+                end = pos + 1 + suffix[pos]
+                values.append(_octets(suffix, pos + 1, end))
+                pos = end
+            elif kind == IMPLIED:
+                values.append(_octets(suffix, pos, len(suffix)))
+                pos = len(suffix)
+            elif kind == INET_ADDRESS:
+                if pos + 1 >= len(suffix):
+                    raise ValueError('index %s too short' % (suffix,))
+                end = pos + 2 + suffix[pos + 1]
+                values.append((suffix[pos], _octets(suffix, pos + 2, end)))
+                pos = end
+            else:
+                raise ValueError('unknown index field kind %r' % kind)
+        if pos != len(suffix):
+            raise ValueError('index %s longer than %s' % (suffix, ', '.join(self.names)))
+        return tuple(values)
+
+    def decode_columns(self, suffixes):
+        width = self.width
+        if width is None or any(len(x) != width for x in suffixes):
+            rows = [self.decode(x) for x in suffixes]
+            columns = {}
+            for i, (name, kind) in enumerate(self.fields):
+                values = [row[i] for row in rows]
+                columns[name] = array.array(_TYPECODES[kind], values) if kind in _TYPECODES else values
+            return columns
+
+        columns = {}
+        pos = 0
+        for name, kind in self.fields:
+            if kind == INTEGER:
+                columns[name] = array.array('I', [x[pos] for x in suffixes])
+            else:
+                end = pos + _WIDTHS[kind]
+                # bytes() rejects sub-identifiers above 255.
+                columns[name] = array.array(_TYPECODES[kind],
+                                            [int.from_bytes(bytes(x[pos:end]), 'big') for x in suffixes])
+            pos += _WIDTHS[kind]
+        return columns
+
+
+def parse_oid(oid):
+    return tuple(int(x) for x in oid.strip('.').split('.'))
+
+
+IP_ADDR_INDEX = IndexSpec(('ip', IPV4))  # ipAddrTable
+ARP_INDEX = IndexSpec(('if_index', INTEGER), ('ip', IPV4))  # ipNetToMediaTable
+IP_NET_TO_PHYSICAL_INDEX = IndexSpec(('if_index', INTEGER), ('address', INET_ADDRESS))  # ipNetToPhysicalTable
+FDB_INDEX = IndexSpec(('mac', MAC))  # dot1dTpFdbTable
+QBRIDGE_FDB_INDEX = IndexSpec(('fdb_id', INTEGER), ('mac', MAC))  # dot1qTpFdbTable
+QBRIDGE_VLAN_INDEX = IndexSpec(('time_mark', INTEGER), ('vlan', INTEGER))  # dot1qVlanCurrentTable
+CDP_CACHE_INDEX = IndexSpec(('if_index', INTEGER), ('device_index', INTEGER))  # cdpCacheTable
+VTP_VLAN_INDEX = IndexSpec(('domain', INTEGER), ('vlan', INTEGER))  # vtpVlanTable
+HSRP_GROUP_INDEX = IndexSpec(('if_index', INTEGER), ('group', INTEGER))  # cHsrpGrpTable
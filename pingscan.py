@@ -2,6 +2,9 @@
 # -*- coding: utf-8 -*-
 
 import array
+import errno
+import os
+import select
 import socket
 import struct
 import sys
@@ -19,10 +22,27 @@ ICMP_CHECKSUM = 0
 ICMP_ID = 0
 ICMP_SEQ_NR = 0
 
+ICMP_ECHO_REPLY = 0
 
-def get_ping_socket():
+# Resolution of the sweep's timeout wheel, in seconds.
+WHEEL_RESOLUTION = 0.01
+
+
+def get_ping_socket(privileged=None):
+    """ICMP socket for echo requests.
+
+    A raw socket needs root or CAP_NET_RAW; an unprivileged datagram ICMP
+    socket needs the group in net.ipv4.ping_group_range (Linux, macOS), and
+    the kernel then sets the echo id and strips the IP header of replies.
+    privileged=None tries raw first, then datagram.
+    """
+    if privileged is None:
+        try:
+            return get_ping_socket(True)
+        except PermissionError:
+            return get_ping_socket(False)
     return socket.socket(socket.AF_INET,
-                         socket.SOCK_RAW,
+                         socket.SOCK_RAW if privileged else socket.SOCK_DGRAM,
                          socket.getprotobyname("icmp"))
 
 
@@ -36,19 +56,19 @@ def _construct(_id, size):
 
     # if size big enough, embed this payload
     header = struct.pack('bbHHh', ICMP_TYPE, ICMP_CODE, ICMP_CHECKSUM, ICMP_ID, ICMP_SEQ_NR + _id)
-    load = "-- IF YOU ARE READING THIS YOU ARE A NERD! --"
+    load = b"-- IF YOU ARE READING THIS YOU ARE A NERD! --"
 
     # space for time
     size -= struct.calcsize("d")
 
     # construct payload based on size, may be omitted :)
-    rest = ""
+    rest = b""
     if size > len(load):
         rest = load
         size -= len(load)
 
     # pad the rest of payload
-    rest += size * "X"
+    rest += size * b"X"
 
     # pack
     data = struct.pack("d", time.time()) + rest
@@ -75,16 +95,13 @@ def _in_cksum(packet):
 
     # add byte if not dividable by 2
     if len(packet) & 1:
-        packet += '\0'
+        packet += b'\0'
 
     # split into 16-bit word and insert into a binary array
-    words = array.array('h', packet)
-    checksum = 0
+    words = array.array('H', packet)
+    checksum = sum(words)
 
     # perform ones complement arithmetic on 16-bit words
-    for word in words:
-        checksum += (word & 0xffff)
-
     hi = checksum >> 16
     lo = checksum & 0xffff
     checksum = hi + lo
@@ -93,17 +110,186 @@ def _in_cksum(packet):
     return (~checksum) & 0xffff  # return ones complement
 
 
+class EchoTemplate(object):
+    """Echo requests that differ only in their sequence number.
+
+    The header and payload are built once into a preallocated buffer and
+    their one's complement sum is kept; packet(seq) writes seq and the
+    checksum updated for it (RFC 1624, the template's seq is 0) into the
+    buffer and returns it, no pass over the payload. The buffer is reused by
+    the next packet() call, so send it before asking for another.
+    """
+    _WORD = struct.Struct('!H')
+
+    def __init__(self, ident, payload=b''):
+        self.buffer = bytearray(struct.pack('!BBHHH', ICMP_TYPE, ICMP_CODE, 0, ident, 0) + payload)
+        data = bytes(self.buffer) + b'\0' * (len(self.buffer) & 1)
+        total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+        while total >> 16:
+            total = (total & 0xffff) + (total >> 16)
+        self.sum = total
+
+    def packet(self, seq):
+        total = self.sum + seq
+        total = (total & 0xffff) + (total >> 16)
+        buffer = self.buffer
+        self._WORD.pack_into(buffer, 2, ~total & 0xffff)
+        self._WORD.pack_into(buffer, 6, seq)
+        return buffer
+
+
 def ping_net(net_mask, ping_socket, wait=0):
     ip_net = IPNetwork(net_mask)
+    packet = _construct(1, 32)
     for ip in ip_net.iter_hosts():
-        packet = _construct(1, 32)
-        ping_socket.sendto(packet, (str(ip), 2))
-        time.sleep(wait)
+        ping_socket.sendto(packet, (str(ip), 0))
+        if wait:
+            time.sleep(wait)
+
+
+class PingSweep(object):
+    """Send echo requests to many hosts and collect the replies.
+
+    One thread drives a non-blocking socket: requests go out paced to `rate`
+    per second, replies are read as they arrive and matched to their
+    request by source address, id and sequence number, and a timeout wheel
+    with WHEEL_RESOLUTION slots expires the requests still outstanding
+    `timeout` seconds after they were sent. run() returns
+    {ip: rtt in seconds, or None}; with count > 1 every host is probed up to
+    count times and the first reply wins.
+    """
+
+    def __init__(self, timeout=1.0, rate=20000, count=1, ping_socket=None, payload_size=ICMP_DATA_STR):
+        self.timeout = timeout
+        self.rate = rate
+        self.count = count
+        self.sock = ping_socket or get_ping_socket()
+        self.sock.setblocking(False)
+        try:
+            # Replies to a fast sweep arrive in bursts.
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        except OSError:
+            pass
+        self.raw = self.sock.type == socket.SOCK_RAW
+        self.ident = os.getpid() & 0xffff
+        self.template = EchoTemplate(self.ident, b'X' * payload_size)
+        self.sent = 0
+        self.received = 0
+
+    def close(self):
+        self.sock.close()
+
+    def _parse(self, data):
+        # (id, seq) of an echo reply, None for any other ICMP message.
+        if self.raw:
+            data = data[(data[0] & 0x0f) * 4:]
+        if len(data) < 8 or data[0] != ICMP_ECHO_REPLY:
+            return None
+        ident, seq = struct.unpack_from('!HH', data, 4)
+        if self.raw and ident != self.ident:
+            return None  # another process' ping, a raw socket sees every ICMP packet
+        return ident, seq
+
+    def run(self, targets):
+        targets = [str(x) for x in targets]
+        results = dict((ip, None) for ip in targets)
+        probes = [(ip, n) for n in range(self.count) for ip in targets]
+        outstanding = {}  # (ip, seq) -> send time
+        wheel = {}  # slot -> [(ip, seq)]
+        sock = self.sock
+        packet = self.template.packet
+        clock = time.perf_counter
+        resolution = WHEEL_RESOLUTION
+
+        start = clock()
+        next_probe = 0
+        slot = int(start / resolution)
+        while next_probe < len(probes) or outstanding:
+            now = clock()
+
+            # Send what the rate allows by now.
+            allowed = min(len(probes), int((now - start) * self.rate) + 1)
+            while next_probe < allowed:
+                ip, n = probes[next_probe]
+                if results[ip] is not None:
+                    next_probe += 1
+                    continue
+                seq = next_probe & 0xffff
+                try:
+                    sock.sendto(packet(seq), (ip, 0))
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        break
+                    next_probe += 1  # unroutable, counts as no reply
+                    continue
+                sent_at = clock()
+                outstanding[(ip, seq)] = sent_at
+                wheel.setdefault(int((sent_at + self.timeout) / resolution) + 1, []).append((ip, seq))
+                next_probe += 1
+                self.sent += 1
+
+            # Read every reply that is already there.
+            while True:
+                try:
+                    data, address = sock.recvfrom(65535)
+                except (BlockingIOError, InterruptedError):
+                    break
+                received_at = clock()
+                parsed = self._parse(data)
+                if parsed is None:
+                    continue
+                sent_at = outstanding.pop((address[0], parsed[1]), None)
+                if sent_at is None:
+                    continue  # a late or duplicate reply
+                self.received += 1
+                if results[address[0]] is None:
+                    results[address[0]] = received_at - sent_at
+
+            # Expire the wheel slots that have passed.
+            now_slot = int(clock() / resolution)
+            while slot <= now_slot:
+                for key in wheel.pop(slot, ()):
+                    outstanding.pop(key, None)
+                slot += 1
+
+            if next_probe < len(probes):
+                wait = max(0.0, (next_probe + 1) / float(self.rate) - (clock() - start))
+            elif outstanding:
+                wait = min(wheel) * resolution - clock() if wheel else 0
+            else:
+                break
+            select.select([sock], [], [], max(0.0, min(wait, resolution)))
+        return results
+
+
+def sweep(targets, timeout=1.0, rate=20000, count=1, ping_socket=None):
+    # {ip: rtt or None} of the given hosts, networks (netaddr or 'a.b.c.d/len') or both.
+    hosts = []
+    for target in targets:
+        if isinstance(target, str) and '/' not in target:
+            hosts.append(target)
+        else:
+            hosts.extend(str(ip) for ip in IPNetwork(str(target)).iter_hosts())
+    ping_sweep = PingSweep(timeout=timeout, rate=rate, count=count, ping_socket=ping_socket)
+    try:
+        return ping_sweep.run(hosts)
+    finally:
+        if ping_socket is None:
+            ping_sweep.close()
 
 
 if __name__ == '__main__':
     try:
         net = sys.argv[1]
-        ping_net(net, get_ping_socket())
     except IndexError:
         print('Usg: python %s subnet/mask\n' % __file__)
+        sys.exit(1)
+    s = time.time()
+    sweep_results = sweep([net])
+    for host, rtt in sweep_results.items():
+        if rtt is not None:
+            print('%-15s %.2f ms' % (host, rtt * 1000))
+    print('%d/%d alive in %.2fs' % (sum(x is not None for x in sweep_results.values()), len(sweep_results),
+                                    time.time() - s))
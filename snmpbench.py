@@ -0,0 +1,121 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import time
+import tracemalloc
+
+import getMacTa
+import snmpsim
+from snmptool import SNMPHelper
+
+logger = logging.getLogger("ICBC")
+
+
+def _count_rows(result):
+    if isinstance(result, dict):
+        if result and all(isinstance(x, list) for x in result.values()):
+            return sum(len(x) for x in result.values())
+    return len(result)
+
+
+def collection_methods(snmp_helper, port):
+    # (name, callable) for every collection path worth timing.
+    lean_helper = SNMPHelper(snmp_helper.ip, snmp_helper.community, port=port, timeout=snmp_helper.timeout,
+                             retries=snmp_helper.retries, lean=True)
+    return [
+        ('get_device_facts', lambda: snmp_helper.get_device_facts(refresh=True)),
+        ('get_if_index', snmp_helper.get_if_index),
+        ('get_if_ip', snmp_helper.get_if_ip),
+        ('get_cdp_info', snmp_helper.get_cdp_info),
+        ('get_vlan_info', snmp_helper.get_vlan_info),
+        ('get_arp', snmp_helper.get_arp),
+        ('get_arp_table', snmp_helper.get_arp_table),
+        ('get_mac_if_info(10)', lambda: snmp_helper.get_mac_if_info(10)),
+        ('get_all_mac_if_info per-vlan', lambda: snmp_helper.get_all_mac_if_info(qbridge=False)),
+        ('get_all_mac_if_info qbridge', lambda: snmp_helper.get_all_mac_if_info(qbridge=True)),
+        ('get_mac_table', snmp_helper.get_mac_table),
+        ('lean get_arp', lean_helper.get_arp),
+        ('lean get_arp_table', lean_helper.get_arp_table),
+        ('lean get_all_mac_if_info per-vlan', lambda: lean_helper.get_all_mac_if_info(qbridge=False)),
+        ('lean get_all_mac_if_info qbridge', lambda: lean_helper.get_all_mac_if_info(qbridge=True)),
+        ('lean get_mac_table', lean_helper.get_mac_table),
+        ('getMacTa.snmp_walk ipNetToMedia',
+         lambda: getMacTa.snmp_walk('127.0.0.1', '1.3.6.1.2.1.4.22.1.2', 'hex', port=port)),
+        ('getMacTa.read_fdb', lambda: getMacTa.read_fdb('127.0.0.1', port=port)),
+    ]
+
+
+def run_benchmarks(device_kwargs=None, latency=0.0, loss=0.0, repeat=3, timeout=1, retries=2):
+    """Time every collection method against a simulated agent in a child process.
+
+    Returns one dict per method: rows, walks/sec, rows/sec, request PDUs per
+    walk, client CPU seconds per walk and peak Python memory in KiB. The agent runs in its
+    own process so its CPU time is not charged to the client.
+    """
+    port_queue = multiprocessing.Queue()
+    request_counter = multiprocessing.Value('L', 0, lock=False)
+    agent = multiprocessing.Process(target=snmpsim.run_agent,
+                                    args=(port_queue, request_counter, device_kwargs or {},
+                                          dict(latency=latency, loss=loss)),
+                                    daemon=True)
+    agent.start()
+    port = port_queue.get(timeout=60)
+
+    results = []
+    try:
+        snmp_helper = SNMPHelper('127.0.0.1', port=port, timeout=timeout, retries=retries)
+        for name, method in collection_methods(snmp_helper, port):
+            method()  # warm up engines, bridge port cache and max-repetitions
+            requests = request_counter.value
+            tracemalloc.start()
+            cpu = time.process_time()
+            s = time.time()
+            for _ in range(repeat):
+                result = method()
+            elapsed = time.time() - s
+            cpu = time.process_time() - cpu
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            rows = _count_rows(result) if result is not None else 0
+            results.append(dict(method=name,
+                                rows=rows,
+                                walks_per_sec=repeat / elapsed,
+                                rows_per_sec=rows * repeat / elapsed,
+                                pdus=float(request_counter.value - requests) / repeat,
+                                cpu=cpu / repeat,
+                                peak_kib=peak / 1024.0))
+    finally:
+        agent.terminate()
+    return results
+
+
+def print_results(results):
+    print('%-36s %8s %10s %10s %8s %10s %10s' % ('method', 'rows', 'walks/s', 'rows/s', 'PDUs', 'cpu ms',
+                                                  'peak KiB'))
+    for r in results:
+        print('%-36s %8d %10.1f %10.0f %8.1f %10.1f %10.0f' % (
+            r['method'], r['rows'], r['walks_per_sec'], r['rows_per_sec'], r['pdus'], r['cpu'] * 1000,
+            r['peak_kib']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SNMPHelper against a local simulated agent.')
+    parser.add_argument('--interfaces', type=int, default=48)
+    parser.add_argument('--vlans', type=int, default=10)
+    parser.add_argument('--arp', type=int, default=2000)
+    parser.add_argument('--macs-per-vlan', type=int, default=200)
+    parser.add_argument('--no-qbridge', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of requests dropped')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    bench_results = run_benchmarks(dict(interfaces=args.interfaces, vlans=args.vlans, arp=args.arp,
+                                        macs_per_vlan=args.macs_per_vlan, qbridge=not args.no_qbridge),
+                                   latency=args.latency, loss=args.loss, repeat=args.repeat)
+    if args.json:
+        print(json.dumps(bench_results, indent=2))
+    else:
+        print_results(bench_results)
@@ -0,0 +1,196 @@
+import argparse
+import logging
+import sys
+import traceback
+
+import snmpsim
+from snmpdelta import IncrementalPoller
+from snmpsim import v2c
+from snmptable import CDP_SWITCH, LocatorIndex, MacTable
+from snmptool import SNMPHelper
+
+logger = logging.getLogger("ICBC")
+
+TEST_TABLE = (1, 3, 6, 1, 4, 1, 99999, 1, 1)  # columns of a made-up table, under an unused enterprise
+CDP_CACHE = (1, 3, 6, 1, 4, 1, 9, 9, 23, 1, 2, 1, 1)  # cdpCacheEntry
+VTP_VLAN = (1, 3, 6, 1, 4, 1, 9, 9, 46, 1, 3, 1, 1)  # vtpVlanEntry
+QBRIDGE_FDB = (1, 3, 6, 1, 2, 1, 17, 7, 1, 2, 2, 1)  # dot1qTpFdbEntry
+
+
+def _expect(condition, message, *args):
+    if not condition:
+        raise AssertionError(message % args)
+
+
+def _helper(agent, **kwargs):
+    snmp_helper = SNMPHelper(agent.host, port=agent.port, timeout=1, retries=1, **kwargs)
+    # Small responses, so every walk takes several GETBULK requests.
+    snmp_helper.max_repetitions = 5
+    return snmp_helper
+
+
+def check_sparse_columns():
+    # Columns missing rows, with rows the first column lacks, and ending early, on both walk paths.
+    columns = [set(range(1, 41)), set(range(1, 41)) - {5}, {3, 17, 18, 40}, set(range(1, 60, 3)), set(range(1, 6))]
+    oid_values = {}
+    for column, indexes in enumerate(columns):
+        for index in indexes:
+            oid_values[TEST_TABLE + (column + 2, index)] = v2c.Integer(column * 1000 + index)
+    expected = [(index, [column * 1000 + index if index in indexes else None
+                         for column, indexes in enumerate(columns)])
+                for index in sorted(columns[0])]
+
+    agent = snmpsim.SimulatedAgent({'': oid_values}).start()
+    try:
+        for lean in (False, True):
+            snmp_helper = _helper(agent)
+            rows = snmp_helper.walk_table([TEST_TABLE + (column + 2,) for column in range(len(columns))], lean=lean)
+            rows = [(index[0], [None if x is None else int(x) for x in values]) for index, values in rows]
+            _expect(rows == expected, 'lean=%s: rows differ from the table, first %s', lean,
+                    next((x for x, y in zip(rows, expected) if x != y), rows[len(expected):] or 'missing rows'))
+    finally:
+        agent.stop()
+
+
+def check_qbridge_without_vtp():
+    # A Q-BRIDGE switch without CISCO-VTP-MIB still reports its MACs, under VLAN ids, not FDB ids.
+    contexts = snmpsim.synthetic_device(vlans=3, arp=0, macs_per_vlan=5)
+    for oid in [x for x in contexts[''] if x[:len(VTP_VLAN)] == VTP_VLAN]:
+        del contexts[''][oid]
+
+    agent = snmpsim.SimulatedAgent(contexts).start()
+    try:
+        snmp_helper = _helper(agent)
+        vlans = list(snmp_helper.get_vlan_info())
+        _expect(vlans == [], 'VTP VLANs %s on a device without them', vlans)
+        fdb_dict = snmp_helper.get_all_fdb(vlans)
+        _expect(sorted(fdb_dict) == [10, 11, 12], 'Q-BRIDGE VLANs %s, expected 10, 11 and 12', sorted(fdb_dict))
+        _expect(all(len(x) == 5 for x in fdb_dict.values()), 'Q-BRIDGE MACs per VLAN %s, expected 5',
+                [len(x) for x in fdb_dict.values()])
+    finally:
+        agent.stop()
+
+
+def check_qbridge_empty_vlan():
+    # A VTP VLAN without learnt MACs still gets its (empty) entry from the Q-BRIDGE walk.
+    contexts = snmpsim.synthetic_device(vlans=3, arp=0, macs_per_vlan=5)
+    for oid in [x for x in contexts[''] if x[:len(QBRIDGE_FDB)] == QBRIDGE_FDB and x[len(QBRIDGE_FDB) + 1] == 2]:
+        del contexts[''][oid]  # FDB id 2 is VLAN 11
+
+    agent = snmpsim.SimulatedAgent(contexts).start()
+    try:
+        snmp_helper = _helper(agent)
+        vlans = list(snmp_helper.get_vlan_info())
+        mac_if_info = snmp_helper.get_all_mac_if_info(vlans)
+        _expect(all(x in mac_if_info for x in vlans), 'VLANs %s missing from %s', vlans, sorted(mac_if_info))
+        _expect(mac_if_info[11] == [], 'VLAN 11 has %d MACs, expected none', len(mac_if_info[11]))
+        _expect(len(mac_if_info[10]) == 5, 'VLAN 10 has %d MACs, expected 5', len(mac_if_info[10]))
+    finally:
+        agent.stop()
+
+
+def check_incremental_failure():
+    # A table whose walk failed is walked again at the next poll, not full_every polls later.
+    agent = snmpsim.SimulatedAgent(snmpsim.synthetic_device(vlans=2, arp=0, macs_per_vlan=0)).start()
+    try:
+        snmp_helper = _helper(agent)
+        poller = IncrementalPoller(snmp_helper, ['if_index', 'vlan_info', 'cdp_info'])
+        get_vlan_info = snmp_helper.get_vlan_info
+
+        def fail():
+            raise RuntimeError('simulated failure')
+
+        snmp_helper.get_vlan_info = fail
+        try:
+            poller.poll()
+        except RuntimeError:
+            pass
+        else:
+            _expect(False, 'the failing walk did not raise')
+        snmp_helper.get_vlan_info = get_vlan_info
+
+        changes = poller.poll()
+        _expect('vlan_info' in changes, 'vlan_info not re-walked after a failure, re-walked %s', sorted(changes))
+        _expect(sorted(poller.tables) == ['cdp_info', 'if_index', 'vlan_info'], 'tables %s', sorted(poller.tables))
+        changes = poller.poll()
+        _expect(not changes, 'unchanged tables re-walked: %s', sorted(changes))
+    finally:
+        agent.stop()
+
+
+def check_cdp_sparse_address():
+    # A CDP neighbour with an address type but no address, and one behind an IP phone.
+    contexts = snmpsim.synthetic_device(vlans=1, arp=0, macs_per_vlan=0, cdp=2)
+    default = contexts['']
+    del default[CDP_CACHE + (4, 48, 1)]  # cdpCacheAddress
+    default[CDP_CACHE + (9, 47, 1)] = v2c.OctetString(b'\x00\x00\x04\x90')  # host, phone
+
+    agent = snmpsim.SimulatedAgent(contexts).start()
+    try:
+        cdp_info = _helper(agent).get_cdp_info()
+        _expect(sorted(cdp_info) == [47, 48], 'CDP ports %s, expected 47 and 48', sorted(cdp_info))
+        _expect(cdp_info[48][0]['address'] == '', 'address %r without cdpCacheAddress', cdp_info[48][0]['address'])
+        _expect(cdp_info[48][0]['capabilities'] & CDP_SWITCH, 'capabilities %r', cdp_info[48][0]['capabilities'])
+    finally:
+        agent.stop()
+    return cdp_info
+
+
+def check_locator_updates():
+    # ARP updates with several MACs per IP, and hosts behind a phone located, behind a switch not.
+    locator = LocatorIndex()
+    locator.update_arp('gw', [('10.0.0.1', '00:00:00:00:00:01', 1), ('10.0.0.1', '00:00:00:00:00:02', 1),
+                              ('10.0.0.2', '00:00:00:00:00:01', 1)])
+    locator.update_arp('gw', [])
+    _expect(not locator._ip_macs and not locator._mac_ips, 'ARP entries left after an empty update')
+
+    mac_table = MacTable()
+    mac_table.append(10, 0x000000000001, 47)
+    mac_table.append(10, 0x000000000002, 48)
+    locator.update_switch('sw', mac_table, cdp_info=check_cdp_sparse_address())
+    _expect(locator.locate_mac('00:00:00:00:00:01'), 'host behind the IP phone port not located')
+    _expect(not locator.locate_mac('00:00:00:00:00:02'), 'MAC on the switch uplink located')
+    locator.update_switch('sw', MacTable())
+    _expect(not locator.locate_mac('00:00:00:00:00:01'), 'MAC left after an empty switch update')
+
+
+CHECKS = [
+    ('sparse_columns', check_sparse_columns),
+    ('qbridge_without_vtp', check_qbridge_without_vtp),
+    ('qbridge_empty_vlan', check_qbridge_empty_vlan),
+    ('incremental_failure', check_incremental_failure),
+    ('cdp_sparse_address', check_cdp_sparse_address),
+    ('locator_updates', check_locator_updates),
+]
+
+
+def run_checks(names=None):
+    """Run the behaviour checks against simulated agents on local ports.
+
+    Returns {name: None if passed, else the failure}, for the checks in
+    `names` or all of CHECKS. Exits non-zero on a failure when run as a script.
+    """
+    results = {}
+    for name, check in CHECKS:
+        if names and name not in names:
+            continue
+        try:
+            check()
+            results[name] = None
+        except Exception as e:
+            logger.debug(traceback.format_exc())
+            results[name] = '%s: %s' % (type(e).__name__, e)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check SNMPHelper behaviour against local simulated agents.')
+    parser.add_argument('checks', nargs='*', help='names of the checks to run, all by default')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    check_results = run_checks(args.checks)
+    for check_name, failure in check_results.items():
+        print('%-40s %s' % (check_name, 'ok' if failure is None else 'FAILED ' + failure))
+    sys.exit(1 if any(check_results.values()) else 0)
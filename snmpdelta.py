@@ -0,0 +1,89 @@
+import logging
+
+logger = logging.getLogger("ICBC")
+
+# Re-walk a table when one of these device facts differs from the last poll.
+# if_ip and cdp_info have no change indicator and are re-walked every full_every polls, as
+# are VLANs of VTP transparent switches, which do not bump the revision.
+TABLE_INDICATORS = {
+    'if_index': ('if_table_last_change',),
+    'vlan_info': ('vtp_revision',),
+    'if_ip': (),
+    'cdp_info': (),
+}
+
+
+def table_delta(old, new):
+    # Rows of two {key: row} snapshots as {added: {}, removed: {}, changed: {key: new_row}}.
+    delta = dict(added={}, removed={}, changed={})
+    for key, row in new.items():
+        if key not in old:
+            delta['added'][key] = row
+        elif old[key] != row:
+            delta['changed'][key] = row
+    for key, row in old.items():
+        if key not in new:
+            delta['removed'][key] = row
+    return delta
+
+
+class IncrementalPoller(object):
+    """Keep one device's slow-changing tables current with as few walks as possible.
+
+    Each poll() is one GET of the device facts. A table is re-walked only if
+    the device rebooted (sysUpTime went back), one of its TABLE_INDICATORS
+    changed or is not supported by the agent, or full_every polls have gone
+    by since its last walk. Tables that are not re-walked keep their last
+    snapshot in self.tables; a table whose walk failed, or was not reached
+    because an earlier one failed, stays stale until a walk of it succeeds.
+    """
+
+    def __init__(self, snmp_helper, tables=tuple(TABLE_INDICATORS), full_every=12):
+        self.snmp_helper = snmp_helper
+        self.table_names = tables
+        self.full_every = full_every
+        self.facts = None
+        self.tables = {}
+        self._age = {}
+        self._pending = set()
+
+    def stale_tables(self, facts):
+        if self.facts is None or facts['uptime'] is None or facts['uptime'] < self.facts['uptime']:
+            return list(self.table_names)
+
+        stale = []
+        for name in self.table_names:
+            indicators = TABLE_INDICATORS.get(name, ())
+            if name in self._pending or self._age.get(name, 0) + 1 >= self.full_every:
+                stale.append(name)
+            elif any(facts[x] is None or facts[x] != self.facts[x] for x in indicators):
+                stale.append(name)
+        return stale
+
+    def poll(self):
+        """Refresh the device facts and re-walk the tables that may have changed.
+
+        Returns {table: delta} for the re-walked tables, see table_delta().
+        On the first poll every row shows up as added.
+        """
+        facts = self.snmp_helper.get_device_facts(refresh=True)
+        stale = self.stale_tables(facts)
+        self._pending.update(stale)
+        self.facts = facts
+
+        if 'if_index' in stale:
+            self.snmp_helper.forget_bridge_ports()
+
+        deltas = {}
+        for name in self.table_names:
+            if name not in stale:
+                self._age[name] = self._age.get(name, 0) + 1
+                continue
+            rows = getattr(self.snmp_helper, 'get_%s' % name)()
+            deltas[name] = table_delta(self.tables.get(name, {}), rows)
+            self.tables[name] = rows
+            self._age[name] = 0
+            self._pending.discard(name)
+
+        logger.debug('%s: re-walked %s', self.snmp_helper.ip, ', '.join(stale) or 'nothing')
+        return deltas
@@ -0,0 +1,133 @@
+import threading
+import time
+
+# RFC 6298 smoothing gains and variance multiplier.
+RTT_ALPHA = 0.125
+RTT_BETA = 0.25
+RTT_K = 4
+# Never wait less than this for an answer, agents stall for a while when their CPU is busy.
+MIN_TIMEOUT = 0.5
+# Timeouts are rounded up to one of these (or the caller's maximum), pysnmp keeps one target
+# entry per distinct timeout.
+TIMEOUT_BUCKETS = (0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+
+# Open the circuit after this many requests in a row went unanswered.
+FAILURE_THRESHOLD = 3
+# Seconds a host is skipped once its circuit opens, doubled each time it fails again.
+MIN_COOLDOWN = 30
+MAX_COOLDOWN = 600
+
+
+class HostHealth(object):
+    """RTT estimator and circuit breaker of one SNMP agent.
+
+    timeout() follows the smoothed RTT and its variance the way TCP computes
+    its retransmission timeout, bounded by MIN_TIMEOUT and the configured
+    timeout of the caller. A timeout doubles the next wait until an answer
+    comes back, and answers to re-sent requests are not sampled (Karn).
+    After FAILURE_THRESHOLD unanswered requests the circuit opens and allow()
+    refuses requests for the cooldown; after that one probe request at a time
+    is let through, which either closes the circuit or opens it for twice as
+    long.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.failures = 0
+        self.cooldown = MIN_COOLDOWN
+        self.open_until = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.open_until is None:
+            return 'closed'
+        if time.time() < self.open_until:
+            return 'open'
+        return 'half-open'
+
+    def timeout(self, max_timeout):
+        with self._lock:
+            if self.srtt is None:
+                timeout = max_timeout
+            else:
+                timeout = max(MIN_TIMEOUT, self.srtt + RTT_K * self.rttvar) * self.backoff
+        timeout = max(timeout, MIN_TIMEOUT)
+        return min(next((x for x in TIMEOUT_BUCKETS if x >= timeout), max_timeout), max_timeout)
+
+    def allow(self, max_timeout):
+        with self._lock:
+            if self.open_until is None:
+                return True
+            now = time.time()
+            if now < self.open_until:
+                return False
+            # Half-open: this caller probes, the others wait until it is answered or times out.
+            self.open_until = now + max_timeout
+            self.probing = True
+            return True
+
+    def retry_after(self):
+        with self._lock:
+            if self.open_until is None:
+                return 0
+            return max(0, self.open_until - time.time())
+
+    def record_success(self, rtt=None):
+        # rtt is None for answers to a re-sent request, which cannot be told apart from the original.
+        with self._lock:
+            if rtt is not None:
+                if self.srtt is None:
+                    self.srtt = rtt
+                    self.rttvar = rtt / 2
+                else:
+                    self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+                    self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+            self.backoff = 1
+            self.failures = 0
+            self.cooldown = MIN_COOLDOWN
+            self.open_until = None
+            self.probing = False
+
+    def record_timeout(self):
+        with self._lock:
+            self.backoff = min(self.backoff * 2, 64)
+
+    def record_failure(self):
+        # A request that went unanswered after all of its retries.
+        with self._lock:
+            self.failures += 1
+            if self.probing:
+                self.cooldown = min(self.cooldown * 2, MAX_COOLDOWN)
+                self.probing = False
+            elif self.open_until is not None or self.failures < FAILURE_THRESHOLD:
+                return
+            self.open_until = time.time() + self.cooldown
+
+    def to_dict(self):
+        with self._lock:
+            return dict(srtt=self.srtt, rttvar=self.rttvar, backoff=self.backoff, failures=self.failures,
+                        cooldown=self.cooldown, retry_after=self.open_until and max(0, self.open_until - time.time()))
+
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def host_health(host, port=161):
+    # Process-wide, so estimates carry over between helpers and poll cycles.
+    key = (host, port)
+    health = _hosts.get(key)
+    if health is None:
+        with _hosts_lock:
+            health = _hosts.setdefault(key, HostHealth())
+    return health
+
+
+def snapshot():
+    with _hosts_lock:
+        items = sorted(_hosts.items())
+    return dict(('%s:%s' % key, dict(health.to_dict(), state=health.state)) for key, health in items)
@@ -0,0 +1,88 @@
+import threading
+from collections import OrderedDict
+
+from pysnmp.entity import config
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+
+# Transport targets kept per thread; past this the least recently used one is dropped,
+# with the target address its engine configured for it.
+MAX_TRANSPORT_TARGETS = 256
+
+
+class SnmpEnginePool(object):
+    """Process-wide cache of pysnmp engines, community and transport objects.
+
+    A pysnmp SnmpEngine is not thread safe, so every thread gets one
+    CommandGenerator (and its engine) for the life of the process. Transport
+    targets open their socket on the engine they are first used with, so they
+    are cached per thread as well, up to MAX_TRANSPORT_TARGETS. CommunityData
+    carries no state and is shared by all threads.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._community_data = {}
+
+    def command_generator(self):
+        cmd_gen = getattr(self._local, 'cmd_gen', None)
+        if cmd_gen is None:
+            cmd_gen = cmdgen.CommandGenerator()
+            self._local.cmd_gen = cmd_gen
+            self._local.transport_targets = OrderedDict()
+        return cmd_gen
+
+    def snmp_engine(self):
+        return self.command_generator().snmpEngine
+
+    def community_data(self, community, context=None):
+        # Cisco selects the per-VLAN BRIDGE-MIB instance with community@vlan indexing.
+        if context is not None:
+            context = str(context)
+        key = (community, context)
+        community_data = self._community_data.get(key)
+        if community_data is None:
+            with self._lock:
+                community_data = self._community_data.get(key)
+                if community_data is None:
+                    if context is None:
+                        community_data = cmdgen.CommunityData(community)
+                    else:
+                        community_data = cmdgen.CommunityData('%s@%s' % (community, context))
+                    self._community_data[key] = community_data
+        return community_data
+
+    def transport_target(self, host, port=161, timeout=5, retries=1):
+        self.command_generator()
+        key = (host, port, timeout, retries)
+        transport_targets = self._local.transport_targets
+        transport_target = transport_targets.get(key)
+        if transport_target is None:
+            transport_target = cmdgen.UdpTransportTarget((host, port), timeout=timeout, retries=retries)
+            transport_targets[key] = transport_target
+            if len(transport_targets) > MAX_TRANSPORT_TARGETS:
+                self._drop_target(transport_targets.popitem(last=False)[1])
+        else:
+            transport_targets.move_to_end(key)
+        return transport_target
+
+    def _drop_target(self, transport_target):
+        # Remove the snmpTargetAddrTable rows the command generator's LCD added for a target.
+        snmp_engine = self._local.cmd_gen.snmpEngine
+        cache = snmp_engine.getUserContext('CommandGeneratorLcdConfigurator')
+        if cache is None:
+            return
+        target_key = (transport_target.transportDomain, transport_target.transportAddr, transport_target.timeout,
+                      transport_target.retries)
+        for key in [x for x in cache['addr'] if x[1:5] == target_key]:
+            addr_name, _ = cache['addr'].pop(key)
+            config.delTargetAddr(snmp_engine, addr_name)
+
+    def session(self, host, community, context=None, port=161, timeout=5, retries=1):
+        # Return (cmd_gen, community_data, transport_target) for (host, community, context).
+        return (self.command_generator(),
+                self.community_data(community, context),
+                self.transport_target(host, port, timeout, retries))
+
+
+engine_pool = SnmpEnginePool()
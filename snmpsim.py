@@ -0,0 +1,324 @@
+import bisect
+import heapq
+import logging
+import random
+import socket
+import sys
+import threading
+import time
+
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api, rfc1905
+
+logger = logging.getLogger("ICBC")
+
+v2c = api.protoModules[api.protoVersion2c]
+
+# snmprec tag -> value type, see http://snmplabs.com/snmpsim/documentation/managing-simulation-data.html
+SNMPREC_TYPES = {
+    '2': v2c.Integer,
+    '4': v2c.OctetString,
+    '5': v2c.Null,
+    '6': v2c.ObjectIdentifier,
+    '64': v2c.IpAddress,
+    '65': v2c.Counter32,
+    '66': v2c.Gauge32,
+    '67': v2c.TimeTicks,
+    '68': v2c.Opaque,
+    '70': v2c.Counter64,
+}
+
+
+def load_snmprec(path):
+    # Read an snmprec file (oid|tag|value per line, tag 4x for hex strings) into {oid: value}.
+    oid_values = {}
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            oid, tag, value = line.split('|', 2)
+            oid = tuple(int(x) for x in oid.strip('.').split('.'))
+            if tag.endswith('x'):
+                value = bytes.fromhex(value)
+                tag = tag[:-1]
+            value_type = SNMPREC_TYPES[tag]
+            if value_type in (v2c.OctetString, v2c.Opaque, v2c.IpAddress) or isinstance(value, bytes):
+                oid_values[oid] = value_type(value)
+            elif value_type is v2c.Null:
+                oid_values[oid] = value_type('')
+            elif value_type is v2c.ObjectIdentifier:
+                oid_values[oid] = value_type(value)
+            else:
+                oid_values[oid] = value_type(int(value))
+    return oid_values
+
+
+def _mac(n):
+    return bytes([0x00, 0x50, 0x56, (n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff])
+
+
+def synthetic_device(hostname='sim-switch', interfaces=48, vlans=10, arp=1000, macs_per_vlan=100, cdp=2,
+                     qbridge=True):
+    """Return {context: {oid: value}} for a made-up Cisco access switch.
+
+    Context '' is the plain community; context '<vlan>' is what the switch
+    answers to community@vlan, holding that VLAN's BRIDGE-MIB instance.
+    Physical ports are ifIndex 1..interfaces, VLAN interfaces ifIndex 1000+vlan.
+    """
+    vlan_ids = list(range(10, 10 + vlans))
+    default = {
+        (1, 3, 6, 1, 2, 1, 1, 1, 0): v2c.OctetString('Cisco IOS Software, simulated'),  # sysDescr
+        (1, 3, 6, 1, 2, 1, 1, 2, 0): v2c.ObjectIdentifier((1, 3, 6, 1, 4, 1, 9, 1, 1208)),  # sysObjectID
+        (1, 3, 6, 1, 2, 1, 1, 3, 0): v2c.TimeTicks(123456789),  # sysUpTime
+        (1, 3, 6, 1, 2, 1, 1, 5, 0): v2c.OctetString(hostname),  # sysName
+        (1, 3, 6, 1, 2, 1, 2, 1, 0): v2c.Integer(interfaces + vlans),  # ifNumber
+        (1, 3, 6, 1, 2, 1, 31, 1, 5, 0): v2c.TimeTicks(4242),  # ifTableLastChange
+        (1, 3, 6, 1, 4, 1, 9, 9, 46, 1, 2, 1, 1, 4, 1): v2c.Gauge32(7),  # managementDomainConfigRevNumber
+    }
+
+    if_indexes = list(range(1, interfaces + 1)) + [1000 + x for x in vlan_ids]
+    for if_index in if_indexes:
+        if_name = 'Vlan%d' % (if_index - 1000) if if_index > 1000 else 'GigabitEthernet1/0/%d' % if_index
+        default[(1, 3, 6, 1, 2, 1, 2, 2, 1, 2, if_index)] = v2c.OctetString(if_name)  # ifDescr
+        default[(1, 3, 6, 1, 2, 1, 31, 1, 1, 1, 18, if_index)] = v2c.OctetString('port %d' % if_index)  # ifAlias
+        for column, value in ((6, if_index * 1000003), (10, if_index * 2000003)):  # ifHCIn/OutOctets
+            default[(1, 3, 6, 1, 2, 1, 31, 1, 1, 1, column, if_index)] = v2c.Counter64(value)
+        for column in (13, 14, 19, 20):  # ifIn/OutDiscards, ifIn/OutErrors
+            default[(1, 3, 6, 1, 2, 1, 2, 2, 1, column, if_index)] = v2c.Counter32(if_index)
+
+    for i, vlan_id in enumerate(vlan_ids):
+        ip = (10, i // 256, i % 256, 1)
+        default[(1, 3, 6, 1, 2, 1, 4, 20, 1, 2) + ip] = v2c.Integer(1000 + vlan_id)  # ipAdEntIfIndex
+        default[(1, 3, 6, 1, 2, 1, 4, 20, 1, 3) + ip] = v2c.IpAddress('255.255.255.0')  # ipAdEntNetMask
+        for column, value in ((11, v2c.IpAddress('10.%d.%d.254' % ip[1:3])), (12, v2c.Integer(1)),
+                              (15, v2c.Integer(6))):  # cHsrpGrpVirtualIpAddr, UseConfiguredVirtualIp, StandbyState
+            default[(1, 3, 6, 1, 4, 1, 9, 9, 106, 1, 2, 1, 1, column, 1000 + vlan_id, 1)] = value
+        for column, value in ((2, v2c.Integer(1)), (3, v2c.Integer(1)), (4, v2c.OctetString('VLAN%04d' % vlan_id))):
+            default[(1, 3, 6, 1, 4, 1, 9, 9, 46, 1, 3, 1, 1, column, 1, vlan_id)] = value  # vtpVlanState/Type/Name
+
+    # ARP entries are spread over the VLAN subnets, hosts .2 to .253.
+    for n in range(min(arp, len(vlan_ids) * 252)):
+        i = n % len(vlan_ids)
+        index = (1000 + vlan_ids[i], 10, i // 256, i % 256, 2 + n // len(vlan_ids))
+        default[(1, 3, 6, 1, 2, 1, 4, 22, 1, 2) + index] = v2c.OctetString(_mac(n))  # ipNetToMediaPhysAddress
+
+    for n in range(cdp):
+        index = (interfaces - n, 1)
+        default[(1, 3, 6, 1, 4, 1, 9, 9, 23, 1, 2, 1, 1, 3) + index] = v2c.Integer(1)  # cdpCacheAddressType
+        default[(1, 3, 6, 1, 4, 1, 9, 9, 23, 1, 2, 1, 1, 4) + index] = v2c.OctetString(bytes([10, 255, 0, n + 1]))
+        default[(1, 3, 6, 1, 4, 1, 9, 9, 23, 1, 2, 1, 1, 6) + index] = v2c.OctetString('sim-core-%d.example' % n)
+        default[(1, 3, 6, 1, 4, 1, 9, 9, 23, 1, 2, 1, 1, 7) + index] = v2c.OctetString('TenGigabitEthernet1/1/%d' % n)
+        default[(1, 3, 6, 1, 4, 1, 9, 9, 23, 1, 2, 1, 1, 9) + index] = v2c.OctetString(b'\x00\x00\x00\x29')  # R S I
+
+    contexts = {'': default}
+    bridge_ports = dict((port, port) for port in range(1, interfaces + 1))
+    # Q-BRIDGE FDB ids are numbered apart from the VLAN ids, as on switches without FDB id = VLAN id.
+    fdb_ids = dict((vlan_id, i + 1) for i, vlan_id in enumerate(vlan_ids))
+    for vlan_id in vlan_ids:
+        context = {}
+        for port, if_index in bridge_ports.items():
+            context[(1, 3, 6, 1, 2, 1, 17, 1, 4, 1, 2, port)] = v2c.Integer(if_index)  # dot1dBasePortIfIndex
+        for n in range(macs_per_vlan):
+            mac = tuple(_mac(vlan_id * 65536 + n))
+            port = 1 + n % interfaces
+            context[(1, 3, 6, 1, 2, 1, 17, 4, 3, 1, 2) + mac] = v2c.Integer(port)  # dot1dTpFdbPort
+            if qbridge:
+                index = (fdb_ids[vlan_id],) + mac
+                default[(1, 3, 6, 1, 2, 1, 17, 7, 1, 2, 2, 1, 2) + index] = v2c.Integer(port)  # dot1qTpFdbPort
+                default[(1, 3, 6, 1, 2, 1, 17, 7, 1, 2, 2, 1, 3) + index] = v2c.Integer(3)  # learned
+        contexts[str(vlan_id)] = context
+        if qbridge:
+            # dot1qVlanFdbId, indexed by dot1qVlanTimeMark and VLAN
+            default[(1, 3, 6, 1, 2, 1, 17, 7, 1, 4, 2, 1, 3, 0, vlan_id)] = v2c.Unsigned32(fdb_ids[vlan_id])
+    for port, if_index in bridge_ports.items():
+        default[(1, 3, 6, 1, 2, 1, 17, 1, 4, 1, 2, port)] = v2c.Integer(if_index)
+    return contexts
+
+
+class MibView(object):
+    # Sorted OIDs of one context for GETNEXT/GETBULK lookups.
+
+    def __init__(self, oid_values):
+        self.values = dict(oid_values)
+        self.oids = sorted(self.values)
+
+    def get(self, oid):
+        return self.values.get(oid, rfc1905.noSuchInstance)
+
+    def get_next(self, oid):
+        i = bisect.bisect_right(self.oids, oid)
+        if i >= len(self.oids):
+            return oid, rfc1905.endOfMibView
+        next_oid = self.oids[i]
+        return next_oid, self.values[next_oid]
+
+
+class SimulatedAgent(object):
+    """SNMPv2c agent on a local UDP port serving fixed MIB contexts.
+
+    contexts maps a context name to {oid: value}; community@context selects
+    a context the way Cisco BRIDGE-MIB community indexing does. latency delays
+    every response, loss drops that fraction of requests, max_pdu_size trims
+    GETBULK responses like a real agent. requests counts received PDUs.
+    """
+
+    def __init__(self, contexts, community='public', host='127.0.0.1', port=0, latency=0.0, loss=0.0,
+                 max_pdu_size=1500, request_counter=None):
+        self.views = dict((name, MibView(oid_values)) for name, oid_values in contexts.items())
+        self.community = community
+        self.latency = latency
+        self.loss = loss
+        self.max_pdu_size = max_pdu_size
+        self.requests = 0
+        self.dropped = 0
+        # Optional multiprocessing.Value mirroring `requests` for an agent in a child process.
+        self.request_counter = request_counter
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()
+        self._delayed = []
+        self._delayed_lock = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        self._threads = [threading.Thread(target=self._serve, daemon=True),
+                         threading.Thread(target=self._send_delayed, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._delayed_lock:
+            self._delayed_lock.notify()
+        self.sock.close()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self._running:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _serve(self):
+        while self._running:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except OSError:
+                break
+            self.requests += 1
+            if self.request_counter is not None:
+                self.request_counter.value += 1
+            if self.loss and random.random() < self.loss:
+                self.dropped += 1
+                continue
+            try:
+                response = self.handle(data)
+            except Exception as e:
+                logger.error('simulator: bad request from %s: %s' % (address, e))
+                continue
+            if response is None:
+                continue
+            if self.latency:
+                with self._delayed_lock:
+                    heapq.heappush(self._delayed, (time.time() + self.latency, self.requests, response, address))
+                    self._delayed_lock.notify()
+            else:
+                self.sock.sendto(response, address)
+
+    def _send_delayed(self):
+        # Responses wait in a heap so concurrent requests are delayed in parallel.
+        while self._running:
+            with self._delayed_lock:
+                while self._running and (not self._delayed or self._delayed[0][0] > time.time()):
+                    timeout = self._delayed[0][0] - time.time() if self._delayed else None
+                    self._delayed_lock.wait(timeout)
+                if not self._running:
+                    return
+                _, _, response, address = heapq.heappop(self._delayed)
+            try:
+                self.sock.sendto(response, address)
+            except OSError:
+                return
+
+    def handle(self, data):
+        if int(api.decodeMessageVersion(data)) != api.protoVersion2c:
+            return None
+        request, _ = decoder.decode(data, asn1Spec=v2c.Message())
+        community = str(v2c.apiMessage.getCommunity(request))
+        if community == self.community:
+            view = self.views.get('')
+        elif community.startswith(self.community + '@'):
+            view = self.views.get(community[len(self.community) + 1:])
+        else:
+            view = None
+        if view is None:
+            return None  # wrong community, real agents stay silent
+
+        request_pdu = v2c.apiMessage.getPDU(request)
+        response = v2c.apiMessage.getResponse(request)
+        response_pdu = v2c.apiMessage.getPDU(response)
+        names = [tuple(oid) for oid, _ in v2c.apiPDU.getVarBinds(request_pdu)]
+
+        if request_pdu.isSameTypeWith(v2c.GetRequestPDU()):
+            var_binds = [(oid, view.get(oid)) for oid in names]
+        elif request_pdu.isSameTypeWith(v2c.GetNextRequestPDU()):
+            var_binds = [view.get_next(oid) for oid in names]
+        elif request_pdu.isSameTypeWith(v2c.GetBulkRequestPDU()):
+            non_repeaters = min(int(v2c.apiBulkPDU.getNonRepeaters(request_pdu)), len(names))
+            max_repetitions = int(v2c.apiBulkPDU.getMaxRepetitions(request_pdu))
+            var_binds = [view.get_next(oid) for oid in names[:non_repeaters]]
+            repeaters = names[non_repeaters:]
+            for _ in range(max_repetitions):
+                if not repeaters:
+                    break
+                row = [view.get_next(oid) for oid in repeaters]
+                var_binds.extend(row)
+                repeaters = [oid for oid, _ in row]
+                if all(value is rfc1905.endOfMibView for _, value in row):
+                    break
+            return self._encode_bulk(response, response_pdu, var_binds, non_repeaters, len(names) - non_repeaters)
+        else:
+            v2c.apiPDU.setErrorStatus(response_pdu, 5)  # genErr
+            var_binds = [(oid, v2c.Null('')) for oid in names]
+
+        v2c.apiPDU.setVarBinds(response_pdu, var_binds)
+        data = encoder.encode(response)
+        if len(data) > self.max_pdu_size:
+            v2c.apiPDU.setErrorStatus(response_pdu, 1)  # tooBig
+            v2c.apiPDU.setVarBinds(response_pdu, [])
+            data = encoder.encode(response)
+        return data
+
+    def _encode_bulk(self, response, response_pdu, var_binds, non_repeaters, repeaters):
+        # Drop whole repetitions from the end until the response fits (RFC 3416 4.2.3).
+        while True:
+            v2c.apiPDU.setVarBinds(response_pdu, var_binds)
+            data = encoder.encode(response)
+            if len(data) <= self.max_pdu_size or len(var_binds) <= non_repeaters + repeaters:
+                return data
+            keep = non_repeaters + max(repeaters, (len(var_binds) - non_repeaters) // 2 // repeaters * repeaters)
+            var_binds = var_binds[:keep]
+
+
+def run_agent(port_queue, request_counter, device_kwargs, agent_kwargs):
+    # multiprocessing target: serve a synthetic device and report the bound port.
+    agent = SimulatedAgent(synthetic_device(**device_kwargs), request_counter=request_counter, **agent_kwargs)
+    port_queue.put(agent.port)
+    agent.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sim_port = int(sys.argv[1]) if len(sys.argv) > 1 else 1161
+    if len(sys.argv) > 2:
+        sim_contexts = {'': load_snmprec(sys.argv[2])}
+    else:
+        sim_contexts = synthetic_device()
+    sim_agent = SimulatedAgent(sim_contexts, port=sim_port)
+    logger.info('Simulated agent on %s:%d, contexts %s', sim_agent.host, sim_agent.port, sorted(sim_contexts))
+    sim_agent.serve_forever()
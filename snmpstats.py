@@ -0,0 +1,160 @@
+import functools
+import json
+import os
+import threading
+
+# Upper bounds in seconds of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+COUNTERS = (
+    ('requests', 'Request PDUs sent, retries included.'),
+    ('retries', 'Requests re-sent after a timeout.'),
+    ('timeouts', 'Requests that got no response in time.'),
+    ('errors', 'Responses with an error status or other error indications.'),
+    ('bytes_sent', 'Estimated BER bytes of request PDUs.'),
+    ('bytes_received', 'Estimated BER bytes of response PDUs.'),
+    ('rows', 'Table rows or scalars returned.'),
+)
+
+
+class MethodStats(object):
+    __slots__ = tuple(name for name, _ in COUNTERS) + ('latency_buckets', 'latency_sum', 'latency_count')
+
+    def __init__(self):
+        for name, _ in COUNTERS:
+            setattr(self, name, 0)
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def observe(self, latency):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_buckets[i] += 1
+                break
+        self.latency_sum += latency
+        self.latency_count += 1
+
+    def to_dict(self):
+        result = dict((name, getattr(self, name)) for name, _ in COUNTERS)
+        result['latency'] = dict(buckets=dict(zip(LATENCY_BUCKETS, self.latency_buckets)),
+                                 sum=self.latency_sum,
+                                 count=self.latency_count)
+        return result
+
+
+class SNMPStats(object):
+    """Request counters and latency histograms per (host, method).
+
+    SNMPHelper records every PDU it sends here; the method is the public
+    get_* call that caused it. Export with to_json() or to_prometheus().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, host, method, latency=None, timeout=False, retry=False, error=False,
+               bytes_sent=0, bytes_received=0, rows=0):
+        with self._lock:
+            stats = self._stats.get((host, method))
+            if stats is None:
+                stats = self._stats[(host, method)] = MethodStats()
+            stats.requests += 1
+            stats.retries += retry
+            stats.timeouts += timeout
+            stats.errors += error
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.rows += rows
+            if latency is not None and not timeout:
+                stats.observe(latency)
+
+    def record_response(self, host, method, bytes_received, rows):
+        # Size and row count of a response already counted by record().
+        with self._lock:
+            stats = self._stats.get((host, method))
+            if stats is None:
+                stats = self._stats[(host, method)] = MethodStats()
+            stats.bytes_received += bytes_received
+            stats.rows += rows
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        # {host: {method: {counter: value, latency: {...}}}}
+        with self._lock:
+            result = {}
+            for (host, method), stats in sorted(self._stats.items()):
+                result.setdefault(host, {})[method] = stats.to_dict()
+            return result
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self):
+        lines = []
+        with self._lock:
+            items = sorted(self._stats.items())
+            for name, help_text in COUNTERS:
+                lines.append('# HELP snmp_%s_total %s' % (name, help_text))
+                lines.append('# TYPE snmp_%s_total counter' % name)
+                for (host, method), stats in items:
+                    lines.append('snmp_%s_total{host="%s",method="%s"} %d' % (name, host, method, getattr(stats, name)))
+
+            lines.append('# HELP snmp_request_duration_seconds Round trip time of answered requests.')
+            lines.append('# TYPE snmp_request_duration_seconds histogram')
+            for (host, method), stats in items:
+                labels = 'host="%s",method="%s"' % (host, method)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, stats.latency_buckets):
+                    cumulative += count
+                    lines.append('snmp_request_duration_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+                lines.append('snmp_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, stats.latency_count))
+                lines.append('snmp_request_duration_seconds_sum{%s} %f' % (labels, stats.latency_sum))
+                lines.append('snmp_request_duration_seconds_count{%s} %d' % (labels, stats.latency_count))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # Write for the node_exporter textfile collector; rename so it never reads a partial file.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def write_json(self, path):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_json(indent=2))
+        os.replace(tmp_path, path)
+
+
+_method_context = threading.local()
+
+
+def current_method():
+    return getattr(_method_context, 'name', None)
+
+
+def set_current_method(name):
+    _method_context.name = name
+
+
+def instrumented(func):
+    # Attribute PDUs sent while func runs to it, unless an outer instrumented call already is.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current_method() is not None:
+            return func(*args, **kwargs)
+        set_current_method(func.__name__)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_current_method(None)
+
+    return wrapper
+
+
+stats = SNMPStats()
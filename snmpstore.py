@@ -0,0 +1,215 @@
+import sqlite3
+import threading
+import time
+
+from snmptable import ArpTable, MacTable, int_to_mac, ip_to_int, mac_to_int
+
+# MACs and IPv4 addresses are stored as integers, like ArpTable and MacTable keep them.
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cycles (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS devices (
+    cycle_id INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    zone TEXT,
+    hostname TEXT,
+    uptime INTEGER,
+    description TEXT,
+    object_id TEXT,
+    error TEXT,
+    PRIMARY KEY (cycle_id, host)
+);
+CREATE TABLE IF NOT EXISTS interfaces (
+    cycle_id INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    if_index INTEGER NOT NULL,
+    name TEXT,
+    PRIMARY KEY (cycle_id, host, if_index)
+);
+CREATE TABLE IF NOT EXISTS if_ip (
+    cycle_id INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    if_index INTEGER NOT NULL,
+    ip INTEGER NOT NULL,
+    mask TEXT
+);
+CREATE TABLE IF NOT EXISTS arp (
+    cycle_id INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    ip INTEGER NOT NULL,
+    mac INTEGER NOT NULL,
+    if_index INTEGER
+);
+CREATE TABLE IF NOT EXISTS cdp (
+    cycle_id INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    if_index INTEGER NOT NULL,
+    neighbor TEXT,
+    remote_port TEXT,
+    address TEXT
+);
+CREATE TABLE IF NOT EXISTS vlans (
+    cycle_id INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    vlan INTEGER NOT NULL,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS fdb (
+    cycle_id INTEGER NOT NULL,
+    host TEXT NOT NULL,
+    vlan INTEGER,
+    mac INTEGER NOT NULL,
+    if_index INTEGER
+);
+CREATE INDEX IF NOT EXISTS cycles_started ON cycles (started);
+CREATE INDEX IF NOT EXISTS arp_mac ON arp (mac, cycle_id);
+CREATE INDEX IF NOT EXISTS arp_ip ON arp (ip, cycle_id);
+CREATE INDEX IF NOT EXISTS fdb_mac ON fdb (mac, cycle_id);
+CREATE INDEX IF NOT EXISTS fdb_port ON fdb (host, if_index, cycle_id);
+CREATE INDEX IF NOT EXISTS if_ip_ip ON if_ip (ip, cycle_id);
+'''
+
+INSERT_DEVICE = 'INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+INSERT_INTERFACE = 'INSERT OR REPLACE INTO interfaces VALUES (?, ?, ?, ?)'
+INSERT_IF_IP = 'INSERT INTO if_ip VALUES (?, ?, ?, ?, ?)'
+INSERT_ARP = 'INSERT INTO arp VALUES (?, ?, ?, ?, ?)'
+INSERT_CDP = 'INSERT INTO cdp VALUES (?, ?, ?, ?, ?, ?)'
+INSERT_VLAN = 'INSERT INTO vlans VALUES (?, ?, ?, ?)'
+INSERT_FDB = 'INSERT INTO fdb VALUES (?, ?, ?, ?, ?)'
+
+MAC_HISTORY = '''
+SELECT c.started, f.host, f.vlan, f.if_index, i.name
+FROM fdb f
+JOIN cycles c ON c.id = f.cycle_id
+LEFT JOIN interfaces i ON i.cycle_id = f.cycle_id AND i.host = f.host AND i.if_index = f.if_index
+WHERE f.mac = ? AND f.cycle_id >= ?
+ORDER BY c.started
+'''
+IP_HISTORY = '''
+SELECT c.started, a.host, a.mac, a.if_index
+FROM arp a
+JOIN cycles c ON c.id = a.cycle_id
+WHERE a.ip = ? AND a.cycle_id >= ?
+ORDER BY c.started
+'''
+PORT_HISTORY = '''
+SELECT c.started, f.vlan, f.mac
+FROM fdb f
+JOIN cycles c ON c.id = f.cycle_id
+WHERE f.host = ? AND f.if_index = ? AND f.cycle_id >= ?
+ORDER BY c.started
+'''
+
+
+class SnapshotStore(object):
+    """Poll cycles of collect_device() output in a SQLite database.
+
+    Every cycle gets an id; write_device() stores one device's tables in one
+    transaction with executemany(), so a failed device never leaves half a
+    snapshot behind. The database runs in WAL mode, so history queries can
+    read while a cycle is being written. One connection is shared by all
+    threads behind a lock.
+    """
+
+    def __init__(self, path='snmp.db'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def begin_cycle(self, started=None):
+        with self._lock, self._conn:
+            cursor = self._conn.execute('INSERT INTO cycles (started) VALUES (?)', (started or time.time(),))
+            return cursor.lastrowid
+
+    def finish_cycle(self, cycle_id, finished=None):
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE cycles SET finished = ? WHERE id = ?', (finished or time.time(), cycle_id))
+
+    def write_device(self, cycle_id, host, device, zone=None):
+        facts = device.get('facts') or {}
+        arp = device.get('arp', ())
+        if not isinstance(arp, ArpTable):
+            arp = ArpTable.from_rows(arp)
+        mac_table = device.get('mac_if_info', {})
+        if not isinstance(mac_table, MacTable):
+            mac_table = MacTable.from_mac_if_info(mac_table)
+
+        with self._lock, self._conn:
+            conn = self._conn
+            conn.execute(INSERT_DEVICE, (cycle_id, host, zone, device.get('hostname'), facts.get('uptime'),
+                                         facts.get('description'), facts.get('object_id'), device.get('error')))
+            conn.executemany(INSERT_INTERFACE, ((cycle_id, host, int(if_index), name)
+                                                for if_index, name in device.get('if_index', {}).items()))
+            conn.executemany(INSERT_IF_IP, ((cycle_id, host, int(if_index), ip_to_int(ip), mask)
+                                            for if_index, addresses in device.get('if_ip', {}).items()
+                                            for ip, mask in addresses))
+            conn.executemany(INSERT_ARP, ((cycle_id, host, ip, mac, if_index)
+                                          for ip, mac, if_index in arp.raw_rows()))
+            conn.executemany(INSERT_CDP, ((cycle_id, host, int(if_index), x['neighbor'], x['remote_port'], x['address'])
+                                          for if_index, neighbors in device.get('cdp_info', {}).items()
+                                          for x in neighbors))
+            conn.executemany(INSERT_VLAN, ((cycle_id, host, int(vlan), info.get('name'))
+                                           for vlan, info in device.get('vlan_info', {}).items()))
+            conn.executemany(INSERT_FDB, ((cycle_id, host, vlan, mac, if_index)
+                                          for vlan, mac, if_index in mac_table.raw_rows()))
+
+    def write_fleet(self, fleet, started=None):
+        # Store collect_fleet() output, {zone: {host: device}}, as one new cycle and return its id.
+        cycle_id = self.begin_cycle(started)
+        for zone, devices in fleet.items():
+            for host, device in devices.items():
+                self.write_device(cycle_id, host, device, zone=zone)
+        self.finish_cycle(cycle_id)
+        return cycle_id
+
+    def _first_cycle(self, since):
+        # Lowest cycle id started at or after `since`, so the history queries stay on the (key, cycle_id) indexes.
+        if since is None:
+            return 0
+        with self._lock:
+            row = self._conn.execute('SELECT MIN(id) FROM cycles WHERE started >= ?', (since,)).fetchone()
+        return row[0] if row[0] is not None else float('inf')
+
+    def mac_history(self, mac, since=None):
+        # [(started, host, vlan, if_index, if_name)] of every cycle the MAC was in a switch FDB.
+        if not isinstance(mac, int):
+            mac = mac_to_int(mac)
+        first_cycle = self._first_cycle(since)
+        with self._lock:
+            return self._conn.execute(MAC_HISTORY, (mac, first_cycle)).fetchall()
+
+    def ip_history(self, ip, since=None):
+        # [(started, host, mac, if_index)] of every cycle the address was in an ARP table.
+        if not isinstance(ip, int):
+            ip = ip_to_int(ip)
+        first_cycle = self._first_cycle(since)
+        with self._lock:
+            rows = self._conn.execute(IP_HISTORY, (ip, first_cycle)).fetchall()
+        return [(started, host, int_to_mac(mac), if_index) for started, host, mac, if_index in rows]
+
+    def port_history(self, host, if_index, since=None):
+        # [(started, vlan, mac)] of the MACs learnt on one switch port.
+        first_cycle = self._first_cycle(since)
+        with self._lock:
+            rows = self._conn.execute(PORT_HISTORY, (host, if_index, first_cycle)).fetchall()
+        return [(started, vlan, int_to_mac(mac)) for started, vlan, mac in rows]
+
+    def prune(self, before):
+        # Drop every cycle started before `before` and its rows.
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT MIN(id) FROM cycles WHERE started >= ?', (before,)).fetchone()
+            first_kept = row[0] if row[0] is not None else self._conn.execute(
+                'SELECT COALESCE(MAX(id), 0) + 1 FROM cycles').fetchone()[0]
+            for table in ('devices', 'interfaces', 'if_ip', 'arp', 'cdp', 'vlans', 'fdb', 'cycles'):
+                column = 'id' if table == 'cycles' else 'cycle_id'
+                self._conn.execute('DELETE FROM %s WHERE %s < ?' % (table, column), (first_kept,))
@@ -0,0 +1,365 @@
+import array
+import socket
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# cdpCacheCapabilities bits of the neighbours whose ports are uplinks, router and switch;
+# IP phones and access points (host, trans-bridge) are edge devices with hosts behind them.
+CDP_ROUTER = 0x01
+CDP_SWITCH = 0x08
+CDP_UPLINK = CDP_ROUTER | CDP_SWITCH
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def mac_to_int(mac):
+    if isinstance(mac, (bytes, tuple, list)):
+        return int.from_bytes(bytes(mac), 'big')
+    return int(mac.replace(':', '').replace('-', '').replace('.', ''), 16)
+
+
+def int_to_mac(value):
+    mac_hex = '%012x' % value
+    return ':'.join(mac_hex[i:i + 2] for i in range(0, 12, 2))
+
+
+class ColumnTable(object):
+    """Rows kept as one typed array per column.
+
+    Subclasses list their columns as (name, typecode) in COLUMNS and turn raw
+    integer rows into display strings in format_row(). Columns are plain
+    array.array objects, so tables pickle as a few byte strings.
+    """
+    COLUMNS = ()
+
+    def __init__(self, **columns):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array.array(typecode, columns.get(name, ())))
+
+    def __len__(self):
+        return len(getattr(self, self.COLUMNS[0][0]))
+
+    def __iter__(self):
+        for row in self.raw_rows():
+            yield self.format_row(row)
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name, _ in self.COLUMNS)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def raw_rows(self):
+        return zip(*[getattr(self, name) for name, _ in self.COLUMNS])
+
+    def format_row(self, row):
+        return row
+
+    def append(self, *row):
+        for (name, _), value in zip(self.COLUMNS, row):
+            getattr(self, name).append(value)
+
+    def extend(self, other):
+        for name, _ in self.COLUMNS:
+            getattr(self, name).extend(getattr(other, name))
+
+    @property
+    def nbytes(self):
+        return sum(len(x) * x.itemsize for x in (getattr(self, name) for name, _ in self.COLUMNS))
+
+    def column(self, name):
+        # Zero-copy NumPy view of a column when NumPy is installed.
+        values = getattr(self, name)
+        if numpy is None:
+            return values
+        return numpy.frombuffer(values, dtype=values.typecode) if len(values) else numpy.array([], values.typecode)
+
+    def take(self, positions):
+        table = self.__class__()
+        for name, typecode in self.COLUMNS:
+            values = getattr(self, name)
+            if numpy is not None:
+                selected = self.column(name)[numpy.asarray(positions, dtype=numpy.intp)]
+                setattr(table, name, array.array(typecode, selected.tobytes()))
+            else:
+                setattr(table, name, array.array(typecode, [values[i] for i in positions]))
+        return table
+
+    def mask(self, **conditions):
+        """Positions of rows where every column matches one of the given values.
+
+        e.g. table.mask(if_index=[10101, 10102], vlan=30); returns a NumPy index
+        array when NumPy is installed, else a list.
+        """
+        if numpy is not None:
+            selected = numpy.ones(len(self), dtype=bool)
+            for name, values in conditions.items():
+                values = values if isinstance(values, (list, tuple, set, frozenset)) else [values]
+                selected &= numpy.isin(self.column(name), list(values))
+            return numpy.flatnonzero(selected)
+
+        positions = range(len(self))
+        for name, values in conditions.items():
+            values = set(values) if isinstance(values, (list, tuple, set, frozenset)) else {values}
+            column = getattr(self, name)
+            positions = [i for i in positions if column[i] in values]
+        return list(positions)
+
+    def filter(self, **conditions):
+        return self.take(self.mask(**conditions))
+
+
+class ArpTable(ColumnTable):
+    # IPv4 as uint32, MAC as 48-bit integer in a uint64, ifIndex as uint32.
+    COLUMNS = (('ip', 'I'), ('mac', 'Q'), ('if_index', 'I'))
+
+    @classmethod
+    def from_rows(cls, rows):
+        # Build from get_arp() style (ip, mac, if_index) string rows.
+        table = cls()
+        for ip, mac, if_index in rows:
+            table.append(ip_to_int(ip), mac_to_int(mac), if_index)
+        return table
+
+    def format_row(self, row):
+        ip, mac, if_index = row
+        return int_to_ip(ip), int_to_mac(mac), if_index
+
+
+class MacTable(ColumnTable):
+    COLUMNS = (('vlan', 'H'), ('mac', 'Q'), ('if_index', 'I'))
+
+    @classmethod
+    def from_mac_if_info(cls, mac_if_info):
+        # Build from get_all_mac_if_info() style {vlan: [(mac, if_index)]}.
+        table = cls()
+        for vlan_id, mac_list in mac_if_info.items():
+            for mac, if_index in mac_list:
+                table.append(int(vlan_id), mac_to_int(mac), if_index)
+        return table
+
+    def format_row(self, row):
+        vlan_id, mac, if_index = row
+        return vlan_id, int_to_mac(mac), if_index
+
+
+def merge_arp(tables):
+    # One ArpTable of several ARP tables, e.g. of an HSRP pair, each (ip, mac) once as the first table has it.
+    merged = ArpTable()
+    seen = set()
+    for table in tables:
+        for row in table.raw_rows():
+            if row[:2] not in seen:
+                seen.add(row[:2])
+                merged.append(*row)
+    return merged
+
+
+def join(left, right, on='mac'):
+    """Equi-join two tables on a column.
+
+    Returns (left_positions, right_positions), one pair per matching row
+    combination, to be used with take(). e.g. join(arp_table, mac_table)
+    pairs each ARP entry with every FDB entry of the same MAC.
+    """
+    if numpy is not None:
+        left_values = left.column(on)
+        right_values = right.column(on)
+        order = numpy.argsort(right_values, kind='stable')
+        sorted_values = right_values[order]
+        lo = numpy.searchsorted(sorted_values, left_values, side='left')
+        hi = numpy.searchsorted(sorted_values, left_values, side='right')
+        counts = hi - lo
+        left_positions = numpy.repeat(numpy.arange(len(left_values)), counts)
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        right_positions = order[numpy.repeat(lo, counts) + offsets]
+        return left_positions, right_positions
+
+    right_index = {}
+    for i, value in enumerate(getattr(right, on)):
+        right_index.setdefault(value, []).append(i)
+    left_positions = []
+    right_positions = []
+    for i, value in enumerate(getattr(left, on)):
+        for j in right_index.get(value, ()):
+            left_positions.append(i)
+            right_positions.append(j)
+    return left_positions, right_positions
+
+
+def uplink_ports(cdp_info):
+    # if_indexes of get_cdp_info() output with a switch or router neighbour; a neighbour
+    # without capabilities counts as one.
+    uplinks = set()
+    for if_index, neighbors in (cdp_info or {}).items():
+        for neighbor in neighbors:
+            capabilities = neighbor.get('capabilities')
+            if capabilities is None or capabilities & CDP_UPLINK:
+                uplinks.add(if_index)
+    return uplinks
+
+
+class LocatorIndex(object):
+    """Fleet-wide IP -> MAC -> access switch port lookup.
+
+    ARP tables give ip -> mac, access switch MAC tables give mac -> port.
+    Ports with a CDP neighbour that is a switch or router are uplinks and are
+    left out, so a MAC resolves to the edge port it is plugged into, behind
+    an IP phone or access point too. update_arp() and
+    update_switch() replace one device's entries only, so the index is kept
+    current device by device after each poll instead of being rebuilt;
+    learn_mac(), forget_mac() and forget_port() apply single MAC events in
+    between, e.g. from notification traps.
+    """
+
+    def __init__(self):
+        self._ip_macs = {}  # ip -> {host: mac}
+        self._mac_ips = {}  # mac -> {ip: set(host)}
+        self._mac_ports = {}  # mac -> {host: [(vlan, if_index, if_name)]}
+        self._arp_keys = {}  # host -> set((ip, mac))
+        self._switch_macs = {}  # host -> set(mac)
+        self._uplinks = {}  # host -> set(if_index)
+        self._if_names = {}  # host -> {if_index: if_name}
+
+    def update_arp(self, host, arp_table):
+        if not isinstance(arp_table, ArpTable):
+            arp_table = ArpTable.from_rows(arp_table)
+
+        # One ip can have several macs in a host's table, and one mac several ips.
+        for ip, mac in self._arp_keys.pop(host, ()):
+            ip_macs = self._ip_macs.get(ip, {})
+            ip_macs.pop(host, None)
+            if not ip_macs:
+                self._ip_macs.pop(ip, None)
+            mac_ips = self._mac_ips.get(mac, {})
+            hosts = mac_ips.get(ip)
+            if hosts is not None:
+                hosts.discard(host)
+                if not hosts:
+                    del mac_ips[ip]
+            if not mac_ips:
+                self._mac_ips.pop(mac, None)
+
+        keys = set()
+        for ip, mac, _ in arp_table.raw_rows():
+            self._ip_macs.setdefault(ip, {})[host] = mac
+            self._mac_ips.setdefault(mac, {}).setdefault(ip, set()).add(host)
+            keys.add((ip, mac))
+        self._arp_keys[host] = keys
+
+    def update_switch(self, host, mac_table, if_index_dict=None, cdp_info=None):
+        # mac_table is a MacTable or get_all_mac_if_info() output, cdp_info is get_cdp_info() output.
+        if not isinstance(mac_table, MacTable):
+            mac_table = MacTable.from_mac_if_info(mac_table)
+        if_index_dict = if_index_dict or {}
+        uplinks = uplink_ports(cdp_info)
+        self._if_names[host] = if_index_dict
+        self._uplinks[host] = uplinks
+
+        for mac in self._switch_macs.pop(host, ()):
+            del self._mac_ports[mac][host]
+            if not self._mac_ports[mac]:
+                del self._mac_ports[mac]
+
+        macs = set()
+        for vlan_id, mac, if_index in mac_table.raw_rows():
+            if not if_index or if_index in uplinks:
+                continue
+            ports = self._mac_ports.setdefault(mac, {}).setdefault(host, [])
+            ports.append((vlan_id, if_index, if_index_dict.get(if_index, '')))
+            macs.add(mac)
+        self._switch_macs[host] = macs
+
+    def update_fleet(self, fleet):
+        # Feed collect_fleet() output, {zone: {host: device}}.
+        for devices in fleet.values():
+            for host, device in devices.items():
+                if 'arp' in device:
+                    self.update_arp(host, device['arp'])
+                if 'mac_if_info' in device:
+                    self.update_switch(host, device['mac_if_info'],
+                                       if_index_dict=device.get('if_index'),
+                                       cdp_info=device.get('cdp_info'))
+
+    def remove_device(self, host):
+        self.update_arp(host, ArpTable())
+        self.update_switch(host, MacTable())
+        del self._arp_keys[host]
+        del self._switch_macs[host]
+        self._uplinks.pop(host, None)
+        self._if_names.pop(host, None)
+
+    def learn_mac(self, host, vlan_id, mac, if_index):
+        # One MAC learnt on a switch port, replacing where the switch had it in that VLAN.
+        if not isinstance(mac, int):
+            mac = mac_to_int(mac)
+        self.forget_mac(host, vlan_id, mac)
+        if not if_index or if_index in self._uplinks.get(host, ()):
+            return
+        ports = self._mac_ports.setdefault(mac, {}).setdefault(host, [])
+        ports.append((vlan_id, if_index, self._if_names.get(host, {}).get(if_index, '')))
+        self._switch_macs.setdefault(host, set()).add(mac)
+
+    def forget_mac(self, host, vlan_id, mac):
+        if not isinstance(mac, int):
+            mac = mac_to_int(mac)
+        ports = self._mac_ports.get(mac, {}).get(host)
+        if ports is None:
+            return
+        ports[:] = [x for x in ports if x[0] != vlan_id]
+        if not ports:
+            self._drop_switch_mac(host, mac)
+
+    def forget_port(self, host, if_index):
+        # Every MAC on a switch port, for a link going down.
+        for mac in list(self._switch_macs.get(host, ())):
+            ports = self._mac_ports[mac][host]
+            ports[:] = [x for x in ports if x[1] != if_index]
+            if not ports:
+                self._drop_switch_mac(host, mac)
+
+    def _drop_switch_mac(self, host, mac):
+        del self._mac_ports[mac][host]
+        if not self._mac_ports[mac]:
+            del self._mac_ports[mac]
+        self._switch_macs[host].discard(mac)
+
+    def locate_mac(self, mac):
+        if not isinstance(mac, int):
+            mac = mac_to_int(mac)
+        ips = sorted(self._mac_ips.get(mac, ()))
+        result = []
+        for host, ports in self._mac_ports.get(mac, {}).items():
+            for vlan_id, if_index, if_name in ports:
+                result.append(dict(mac=int_to_mac(mac),
+                                   ip=[int_to_ip(x) for x in ips],
+                                   switch=host,
+                                   vlan=vlan_id,
+                                   if_index=if_index,
+                                   if_name=if_name))
+        return result
+
+    def locate_ip(self, ip):
+        if not isinstance(ip, int):
+            ip = ip_to_int(ip)
+        result = []
+        for mac in set(self._ip_macs.get(ip, {}).values()):
+            result.extend(self.locate_mac(mac))
+        return result
+
+    def locate(self, query):
+        # "Where is X plugged in" for an IPv4 address or a MAC in any common notation.
+        if query.count('.') == 3:
+            return self.locate_ip(query)
+        return self.locate_mac(query)
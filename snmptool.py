@@ -1,385 +1,1121 @@
+import array
+import asyncio
 import json
 import logging
+import multiprocessing
+import os
+import random
+import socket
 import struct
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from pysnmp.entity.rfc3413.oneliner import cmdgen
 # from tornado.log import enable_pretty_logging
+import berdecode
 import pingscan
 # from netaddr import IPNetwork
 from netaddr import IPNetwork
+from oidcodec import (ARP_INDEX, CDP_CACHE_INDEX, FDB_INDEX, HSRP_GROUP_INDEX, IP_ADDR_INDEX, QBRIDGE_FDB_INDEX,
+                      QBRIDGE_VLAN_INDEX, VTP_VLAN_INDEX)
+from pyasn1.type import univ
+from pysnmp.proto import errind, rfc1905
+
+from snmpdelta import IncrementalPoller
+from snmphealth import host_health
+from snmppool import engine_pool
+from snmpstats import current_method, instrumented, set_current_method, stats as default_stats
+from snmpstore import SnapshotStore
+from snmptable import ArpTable, MacTable, int_to_ip, int_to_mac, merge_arp
 
 # enable_pretty_logging()
 
 logger = logging.getLogger("ICBC")
 
+# GETBULK max-repetitions bounds for the adaptive table walker.
+MIN_REPETITIONS = 5
+MAX_REPETITIONS = 100
+DEFAULT_REPETITIONS = 25
+# Cisco's default "snmp-server packetsize" is 1500 bytes, keep responses below it.
+MAX_PDU_SIZE = 1400
+# Grow max-repetitions only while a response comes back faster than this.
+TARGET_PDU_TIME = 0.25
+
+# Tuned max-repetitions per (ip, port), kept across helpers and poll cycles.
+device_repetitions = {}
+# Whether (ip, port) answers Q-BRIDGE-MIB dot1qTpFdbTable, None until tried.
+device_qbridge_support = {}
+
+# IncrementalPoller per (host, community, gateway, access_switch) for collect_device(incremental=True).
+device_pollers = {}
+_device_pollers_lock = threading.Lock()
+
+# Long-lived threads for concurrent walks, so their pooled pysnmp engines stay warm.
+WALK_WORKERS = 64
+_walk_executor = None
+_walk_executor_lock = threading.Lock()
+
+
+def walk_executor():
+    global _walk_executor
+    with _walk_executor_lock:
+        if _walk_executor is None:
+            _walk_executor = ThreadPoolExecutor(max_workers=WALK_WORKERS, thread_name_prefix='snmp-walk')
+    return _walk_executor
+
+
+# Long-lived threads for collect_fleet_async(), so each one's pooled pysnmp engine is built once per
+# process rather than once per cycle. Replaced by a larger pool when a call asks for more workers.
+_fleet_executor = None
+_fleet_executor_workers = 0
+_fleet_executor_lock = threading.Lock()
+
+
+def fleet_executor(max_workers):
+    global _fleet_executor, _fleet_executor_workers
+    with _fleet_executor_lock:
+        if _fleet_executor is None or max_workers > _fleet_executor_workers:
+            if _fleet_executor is not None:
+                _fleet_executor.shutdown(wait=False)
+            _fleet_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='snmp-fleet')
+            _fleet_executor_workers = max_workers
+    return _fleet_executor
+
+
+# Seconds between a subnet's ping sweep and its ARP walk, for the gateway to resolve the hosts.
+ARP_SETTLE = 2.0
+
+# cHsrpGrpStandbyState values.
+HSRP_STANDBY = 5
+HSRP_ACTIVE = 6
+
+# Scalars fetched together by SNMPHelper.get_device_facts().
+DEVICE_FACTS = (
+    ('hostname', '1.3.6.1.2.1.1.5.0'),  # sysName
+    ('uptime', '1.3.6.1.2.1.1.3.0'),  # sysUpTime, hundredths of a second
+    ('description', '1.3.6.1.2.1.1.1.0'),  # sysDescr
+    ('object_id', '1.3.6.1.2.1.1.2.0'),  # sysObjectID
+    ('if_number', '1.3.6.1.2.1.2.1.0'),  # ifNumber
+    ('if_table_last_change', '1.3.6.1.2.1.31.1.5.0'),  # ifTableLastChange, sysUpTime of the last change
+    ('vtp_revision', '1.3.6.1.4.1.9.9.46.1.2.1.1.4.1'),  # managementDomainConfigRevNumber, bumped on VLAN edits
+)
+
+
+class SNMPError(Exception):
+    pass
+
+
+def short_hostname(name):
+    # CDP device ids carry the domain and sometimes a serial number in brackets.
+    return name.split('.')[0].split('(')[0]
+
+
+def _vlan_key(vlan):
+    # VLANs come as ints from VTP and Q-BRIDGE, as strings from traps and callers; maps are kept by int.
+    return None if vlan is None else int(vlan)
+
+
+def oid_tuple(oid):
+    if isinstance(oid, str):
+        return tuple(int(x) for x in oid.strip('.').split('.'))
+    return tuple(oid)
+
+
+def _scalar_value(value):
+    # Plain Python value of a pysnmp scalar: str for strings and OIDs, int for numbers.
+    if value is None:
+        return None
+    if isinstance(value, univ.ObjectIdentifier):
+        return '.'.join(map(str, value))
+    if isinstance(value, univ.OctetString):
+        return value.prettyPrint()
+    return int(value)
+
+
+def _end_of_mib(value):
+    return value is berdecode.END_OF_MIB_VIEW or isinstance(value, rfc1905.EndOfMibView)
+
+
+def _var_bind_size(name, value):
+    # Rough BER size of a varbind: one byte per sub-identifier, the value and the TLV headers.
+    raw = value._value
+    value_size = len(raw) if isinstance(raw, (bytes, tuple)) else 5
+    return len(name) + value_size + 6
+
+
 class SNMPHelper(object):
-    def __init__(self, ip, community='public', port=161, timeout=5, retries=1):
+    def __init__(self, ip, community='public', port=161, timeout=5, retries=1, max_pdu_size=MAX_PDU_SIZE,
+                 stats=None, lean=False):
         self.ip = ip
         self.community = community
         self.port = port
         self.timeout = timeout
         self.retries = retries
-        self.cmd_gen = cmdgen.CommandGenerator()
-        self.community_data = cmdgen.CommunityData(community)
-        self.transport_target = cmdgen.UdpTransportTarget((ip, port),
-                                                          timeout=timeout,
-                                                          retries=retries)
+        self.max_pdu_size = max_pdu_size
+        self.stats = stats if stats is not None else default_stats
+        # Walk the large ARP, bridge and FDB tables with berdecode instead of pysnmp.
+        self.lean = lean
+        # RTT estimate and circuit breaker of (ip, port), kept across helpers and poll cycles.
+        self.health = host_health(ip, port)
+        # dot1dBasePort -> ifIndex, shared by every VLAN context of this switch.
+        self._bridge_port_map = {}
+        # int vlan -> the VLAN's own map, for VLAN contexts whose map disagrees with the shared one.
+        self._vlan_bridge_port_maps = {}
+        self._bridge_port_lock = threading.Lock()
+        self._device_facts = None
+        self.device_fact_errors = {}
 
-    def get_hostname(self):
-        sys_name_oid = '.1.3.6.1.2.1.1.5.0'
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind = cmd_gen.getCmd(
-            self.community_data,
-            self.transport_target,
-            sys_name_oid,
-        )
-
-        hostname = 'Unknown'
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
+    # Engines and targets come from the process-wide pool, so creating a
+    # helper per device and per cycle does not pay the pysnmp setup again.
+    @property
+    def cmd_gen(self):
+        return engine_pool.command_generator()
+
+    @property
+    def community_data(self):
+        return engine_pool.community_data(self.community)
+
+    @property
+    def transport_target(self):
+        return engine_pool.transport_target(self.ip, self.port, self.timeout, self.retries)
+
+    @property
+    def max_repetitions(self):
+        return device_repetitions.get((self.ip, self.port), DEFAULT_REPETITIONS)
+
+    @max_repetitions.setter
+    def max_repetitions(self, value):
+        device_repetitions[(self.ip, self.port)] = value
+
+    def _tune_repetitions(self, max_repetitions, row_count, row_size, elapsed):
+        # Largest repetition count whose response still fits in one PDU.
+        if row_count:
+            limit = int(self.max_pdu_size / (float(row_size) / row_count))
+            limit = max(MIN_REPETITIONS, min(MAX_REPETITIONS, limit))
         else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind[int(error_index) - 1] or '?',
+            limit = MAX_REPETITIONS
 
-                ))
-            else:
-                oid, hostname = var_bind[0]
+        if elapsed > TARGET_PDU_TIME:
+            max_repetitions = max(MIN_REPETITIONS, max_repetitions // 2)
+        elif row_count >= max_repetitions:
+            max_repetitions = max_repetitions * 2
+        self.max_repetitions = min(max_repetitions, limit)
+
+    def _send(self, send, bytes_sent):
+        """Run send(timeout) up to self.retries + 1 times until it is answered.
+
+        send returns (result, status), status one of 'ok', 'error' (answered
+        with an error status), 'timeout' or 'failed' (no answer for another
+        reason). Every attempt is counted in self.stats, and the timeout of
+        each attempt comes from the host's RTT estimate, with self.timeout as
+        the upper bound. Raises SNMPError without sending anything while the
+        host's circuit breaker is open. Returns result + (elapsed,).
+        """
+        method = current_method() or 'walk'
+        if not self.health.allow(self.timeout):
+            raise SNMPError('%s: unreachable, skipped for another %.0fs' % (self.ip, self.health.retry_after()))
+
+        for attempt in range(self.retries + 1):
+            s = time.time()
+            result, status = send(self.health.timeout(self.timeout))
+            elapsed = time.time() - s
+            timeout = status == 'timeout'
+            if timeout:
+                self.health.record_timeout()
+            elif status != 'failed':
+                self.health.record_success(None if attempt else elapsed)
+            if timeout and attempt < self.retries:
+                self.stats.record(self.ip, method, timeout=True, retry=attempt > 0, bytes_sent=bytes_sent)
+                continue
+            if timeout:
+                self.health.record_failure()
+            self.stats.record(self.ip, method, latency=elapsed, timeout=timeout, retry=attempt > 0,
+                              error=status in ('error', 'failed'), bytes_sent=bytes_sent)
+            return result + (elapsed,)
+
+    def _request(self, command, community_data, *args, **kwargs):
+        # One pysnmp oneliner command through _send(), pysnmp itself is given retries=0.
+        # Returns (error_indication, error_status, error_index, var_binds, elapsed).
+        def send(timeout):
+            transport_target = engine_pool.transport_target(self.ip, self.port, timeout, 0)
+            result = command(community_data, transport_target, *args, lookupMib=False, **kwargs)
+            error_indication, error_status = result[:2]
+            if isinstance(error_indication, errind.RequestTimedOut):
+                return result, 'timeout'
+            if error_indication:
+                return result, 'failed'
+            return result, 'error' if error_status else 'ok'
+
+        bytes_sent = 30 + len(self.community) + sum(len(oid_tuple(x)) + 4 for x in args if isinstance(x, (str, tuple)))
+        return self._send(send, bytes_sent)
 
-        return hostname
+    def _lean_request(self, sock, request, request_id):
+        # One encoded request over a plain UDP socket, answered by a response decoded with berdecode.
+        # Returns (error_indication, error_status, error_index, var_binds, response_size, elapsed).
+        def send(timeout):
+            deadline = time.time() + timeout
+            sock.send(request)
+            while True:
+                sock.settimeout(max(deadline - time.time(), 0.001))
+                try:
+                    data = sock.recv(65535)
+                except socket.timeout:
+                    return ('No SNMP response received before timeout', 0, 0, [], 0), 'timeout'
+                except OSError as e:
+                    return (str(e), 0, 0, [], 0), 'failed'
+                try:
+                    response_id, error_status, error_index, var_binds = berdecode.decode_response(data)
+                except ValueError as e:
+                    logger.warning('%s: dropped response, %s' % (self.ip, e))
+                    continue
+                if response_id != request_id:
+                    continue  # late answer to an earlier request
+                return (None, error_status, error_index, var_binds, len(data)), 'error' if error_status else 'ok'
 
+        return self._send(send, len(request))
+
+    def walk_table(self, columns, context=None, lean=False):
+        return list(self.iter_table(columns, context=context, lean=lean))
+
+    def iter_table(self, columns, context=None, lean=False):
+        """Walk one or more columns of a table in lock step with GETBULK.
+
+        Yields (index, values) as each response arrives: index is the OID suffix
+        of the first column and values holds one pysnmp value per column, None
+        where a sparse column has no instance for that index. The walk stops at
+        the first row outside the first column's subtree.
+
+        A sparse column runs ahead of the first one in a response; its values
+        are matched to rows by index, and its next request starts again from
+        the last row yielded rather than from where it ran to. A row is only
+        yielded once every column has reached or passed its index.
+
+        With lean, requests go out on a plain UDP socket and responses are
+        decoded by berdecode, so values are native ints, bytes and tuples
+        instead of pysnmp objects.
+        """
+        columns = [oid_tuple(x) for x in columns]
+        first_column = columns[0]
+        next_oids = list(columns)
+        last_index = None  # index of the last row yielded
+        method = current_method() or 'walk'
+        if lean:
+            community = self.community if context is None else '%s@%s' % (self.community, context)
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((self.ip, self.port))
+        else:
+            community_data = engine_pool.community_data(self.community, context)
+
+        try:
+            while True:
+                max_repetitions = self.max_repetitions
+                if lean:
+                    request_id = random.randint(1, 0x7fffffff)
+                    request = berdecode.encode_get_bulk(community, request_id, 0, max_repetitions, next_oids)
+                    error_indication, error_status, error_index, var_binds, response_size, elapsed = \
+                        self._lean_request(sock, request, request_id)
+                    width = len(columns)
+                    var_bind_table = [var_binds[i:i + width] for i in range(0, len(var_binds) - width + 1, width)]
+                else:
+                    # lookupMib=False is passed in _request(), the oneliner's lookupNames=False does not reach hlapi.
+                    error_indication, error_status, error_index, var_bind_table, elapsed = self._request(
+                        self.cmd_gen.bulkCmd,
+                        community_data,
+                        0, max_repetitions,
+                        *next_oids,
+                        maxCalls=1,
+                        lexicographicMode=True
+                    )
+
+                if error_indication:
+                    logger.error('%s: %s' % (error_indication, self.ip))
+                    raise SNMPError(error_indication)
+                if error_status:
+                    if int(error_status) == 1 and max_repetitions > MIN_REPETITIONS:  # tooBig
+                        self.max_repetitions = max(MIN_REPETITIONS, max_repetitions // 2)
+                        continue
+                    logger.error('%s: %s at %s' % (
+                        self.ip,
+                        berdecode.error_status_name(int(error_status)),
+                        error_index and var_bind_table and var_bind_table[-1][int(error_index) - 1] or '?'
+                    ))
+                    return
+
+                if not lean:
+                    response_size = 30 + len(self.community) + sum(
+                        _var_bind_size(oid_tuple(x), y) for row in var_bind_table for x, y in row)
+                self._tune_repetitions(max_repetitions, len(var_bind_table), response_size, elapsed)
+
+                # Each column's (index, value) run in this response, and whether it left its subtree.
+                runs = []
+                done = []
+                for i, column in enumerate(columns):
+                    run = []
+                    column_done = not var_bind_table
+                    for var_bind_row in var_bind_table:
+                        # At end of MIB pysnmp hands back the request OID, a plain tuple.
+                        name, value = var_bind_row[i]
+                        name = oid_tuple(name)
+                        if name[:len(column)] != column or _end_of_mib(value):
+                            column_done = True
+                            break
+                        run.append((name[len(column):], value))
+                    runs.append(run)
+                    done.append(column_done)
+
+                if runs[0] and next_oids[0][:len(first_column)] == first_column and \
+                        first_column + runs[0][0][0] <= next_oids[0]:
+                    logger.error('%s: OID not increasing at %s' % (
+                        self.ip, '.'.join(map(str, first_column + runs[0][0][0]))))
+                    return
+
+                rows = []
+                positions = [0] * len(columns)
+                next_row = None  # index of the first row of this response not yielded
+                for index, value in runs[0]:
+                    values = [value]
+                    for i in range(1, len(columns)):
+                        run = runs[i]
+                        if not done[i] and (not run or run[-1][0] < index):
+                            break  # this column has not got as far as the row yet
+                        position = positions[i]
+                        while position < len(run) and run[position][0] < index:
+                            position += 1
+                        positions[i] = position
+                        values.append(run[position][1] if position < len(run) and run[position][0] == index
+                                      else None)
+                    else:
+                        rows.append((index, values))
+                        last_index = index
+                        continue
+                    next_row = index
+                    break
+                self.stats.record_response(self.ip, method, response_size, len(rows))
+
+                for row in rows:
+                    yield row
+
+                if done[0] and next_row is None:
+                    return
+
+                next_oids = []
+                for i, column in enumerate(columns):
+                    run = runs[i]
+                    if next_row is not None and not done[i] and run[-1][0] < next_row:
+                        # A column still behind the rows carries on from where it got to.
+                        next_oids.append(column + run[-1][0])
+                    else:
+                        next_oids.append(column + (last_index or ()))
+        finally:
+            if lean:
+                sock.close()
+
+    def get_scalars(self, oids):
+        """GET scalar OIDs, all in one PDU when the agent allows.
+
+        Returns (values, errors): values maps each answered OID, as given, to
+        its pysnmp value, errors maps the others to why not, noSuchObject,
+        noSuchInstance or the error status of the PDU. A tooBig response
+        splits the request in two, an error status naming one OID drops it
+        and asks again for the rest.
+        """
+        values = {}
+        errors = {}
+        pending = [list(oids)]
+        while pending:
+            batch = pending.pop()
+            if not batch:
+                continue
+            error_indication, error_status, error_index, var_binds, _ = self._request(
+                self.cmd_gen.getCmd,
+                self.community_data,
+                *batch
+            )
+
+            if error_indication:
+                logger.error('%s: %s' % (error_indication, self.ip))
+                raise SNMPError(error_indication)
+            if error_status:
+                error_index = int(error_index)
+                if int(error_status) == 1 and len(batch) > 1:  # tooBig
+                    pending += [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+                elif 0 < error_index <= len(batch):
+                    errors[batch[error_index - 1]] = error_status.prettyPrint()
+                    pending.append(batch[:error_index - 1] + batch[error_index:])
+                else:
+                    for oid in batch:
+                        errors[oid] = error_status.prettyPrint()
+                continue
+
+            for oid, (_, value) in zip(batch, var_binds):
+                if isinstance(value, rfc1905.NoSuchObject):
+                    errors[oid] = 'noSuchObject'
+                elif isinstance(value, rfc1905.NoSuchInstance):
+                    errors[oid] = 'noSuchInstance'
+                else:
+                    values[oid] = value
+
+        return values, errors
+
+    @instrumented
+    def get_device_facts(self, refresh=False):
+        # System scalars in one round trip, cached on the helper; facts the agent lacks are None.
+        if self._device_facts is None or refresh:
+            values, errors = self.get_scalars([oid for _, oid in DEVICE_FACTS])
+            self._device_facts = dict((name, _scalar_value(values.get(oid))) for name, oid in DEVICE_FACTS)
+            self.device_fact_errors = dict((name, errors[oid]) for name, oid in DEVICE_FACTS if oid in errors)
+            if self.device_fact_errors:
+                logger.debug('%s: missing device facts %s' % (self.ip, self.device_fact_errors))
+        return self._device_facts
+
+    @instrumented
+    def get_hostname(self):
+        hostname = self.get_device_facts()['hostname']
+        return 'Unknown' if hostname is None else hostname
+
+    @instrumented
     def get_if_index(self):
         if_name_oid = '1.3.6.1.2.1.2.2.1.2'  # ifName
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            self.community_data,
-            self.transport_target,
-            0, 20,
-            if_name_oid,  # interface name
-        )
 
         interface_dict = {}
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
-            else:
-                for varBindTableRow in var_bind_table:
-                    o0, if_name = varBindTableRow[0]
-                    mib_tuple = o0._value
-                    if mib_tuple[:-1] != tuple([int(x) for x in if_name_oid.split('.')]):
-                        break
-                    if_index = mib_tuple[-1]
-                    interface_dict[if_index] = if_name.prettyPrint().decode()
-        
+        for index, (if_name,) in self.walk_table([if_name_oid]):
+            interface_dict[index[0]] = if_name.prettyPrint()
+
         return interface_dict
 
+    @instrumented
     def get_if_ip(self):
         if_ip_oid_str = '1.3.6.1.2.1.4.20.1.2'  # in RFC1213MIB
         if_mask_oid_str = '1.3.6.1.2.1.4.20.1.3'  # in RFC1213MIB
 
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            self.community_data,
-            self.transport_target,
-            0, 20,
-            if_ip_oid_str,
-            if_mask_oid_str,
-        )
-
         interface_dict = {}
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
-            else:
-                for varBindTableRow in var_bind_table:
-                    o0_value, if_index_value = varBindTableRow[0]
-                    o1_value, mask_value = varBindTableRow[1]
-                    oid_str = o0_value.prettyPrint()
-                    oid_str_list = oid_str.split('.')
-
-                    if_index = if_index_value._value
-                    mask = mask_value.prettyPrint()
-                    if not oid_str.startswith(if_ip_oid_str):
-                        break
-                    ip_address = '.'.join(oid_str_list[-4:])
-                    if_net_list = interface_dict.get(if_index, [])
-                    if_net_list.append((ip_address, mask))
-                    interface_dict[if_index] = if_net_list
-        
+        for index, (if_index_value, mask_value) in self.walk_table([if_ip_oid_str, if_mask_oid_str]):
+            if mask_value is None:
+                continue
+            ip_address = int_to_ip(IP_ADDR_INDEX.decode(index)[0])
+            interface_dict.setdefault(int(if_index_value), []).append((ip_address, mask_value.prettyPrint()))
+
         return interface_dict
 
+    @instrumented
     def get_if_desc(self):
         if_desc_oid_str = '1.3.6.1.2.1.31.1.1.1.18'
 
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            self.community_data,
-            self.transport_target,
-            0, 20,
-            if_desc_oid_str,
-        )
-
         interface_dict = {}
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
-            else:
-                for varBindTableRow in var_bind_table:
-                    o0, if_desc = varBindTableRow[0]
-                    mib_tuple = o0._value
-                    if mib_tuple[:-1] != tuple([int(x) for x in if_desc_oid_str.split('.')]):
-                        break
-                    if_index = mib_tuple[-1]
-                    interface_dict[if_index] = if_desc.prettyPrint().decode()
-        
-        return interface_dict
+        for index, (if_desc,) in self.walk_table([if_desc_oid_str]):
+            interface_dict[index[0]] = if_desc.prettyPrint()
 
+        return interface_dict
 
+    @instrumented
     def get_hsrp(self):
-        hsrp_oid_str = '1.3.6.1.4.1.9.9.106.1.2.1.1.11'  # ciscoHsrpMIB
-        hsrp_state_oid_str = '1.3.6.1.4.1.9.9.106.1.2.1.1.12'  # ciscoHsrpMIB
-
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            self.community_data,
-            self.transport_target,
-            0, 20,
-            hsrp_oid_str,
-            hsrp_state_oid_str
-        )
-
-        hsrp_list = []
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
-            else:
-                for varBindTableRow in var_bind_table:
-                    o0_value, ip_value = varBindTableRow[0]
-                    _, state_value = varBindTableRow[1]
-                    oid_str = o0_value.prettyPrint()
-                    if_index = o0_value._value[-2]
-                    if not oid_str.startswith(hsrp_oid_str):
-                        break
-                    if state_value.prettyPrint() != "1":
-                        continue
-                    hsrp_list.append((if_index, ip_value.prettyPrint()))
+        # Return [(if_index, virtual_ip)] of the HSRP groups this router is active for.
+        return [(if_index, virtual_ip) for (if_index, _), (virtual_ip, state) in sorted(self.get_hsrp_groups().items())
+                if state == HSRP_ACTIVE]
+
+    @instrumented
+    def get_hsrp_groups(self):
+        # Return {(if_index, group): (virtual_ip, state)} of every HSRP group, state as cHsrpGrpStandbyState.
+        hsrp_oid_str = '1.3.6.1.4.1.9.9.106.1.2.1.1.11'  # cHsrpGrpVirtualIpAddr
+        hsrp_state_oid_str = '1.3.6.1.4.1.9.9.106.1.2.1.1.15'  # cHsrpGrpStandbyState
 
-        return hsrp_list
+        groups = {}
+        for index, (ip_value, state_value) in self.walk_table([hsrp_oid_str, hsrp_state_oid_str], lean=self.lean):
+            if ip_value is None or state_value is None:
+                continue
+            groups[HSRP_GROUP_INDEX.decode(index)] = (socket.inet_ntoa(bytes(ip_value)), int(state_value))
+        return groups
 
+    def get_hsrp_standby_interfaces(self):
+        # ifIndexes whose every HSRP group has this router in standby, i.e. whose ARP the active peer has.
+        states = {}
+        for (if_index, _), (_, state) in self.get_hsrp_groups().items():
+            states.setdefault(if_index, set()).add(state)
+        return sorted(if_index for if_index, x in states.items() if x == {HSRP_STANDBY})
+
+    @instrumented
     def get_arp(self, if_index_list=None):
+        return list(self.iter_arp(if_index_list))
+
+    def iter_arp(self, if_index_list=None):
+        # Yield (ip, mac, if_index) rows as the walk goes, of the given interfaces only with if_index_list.
         # arp_oid_str = '1.3.6.1.2.1.4.35.1.4'  # ipNetToPhysicalPhysAddress in IPMIB
         # arp_oid_str = '1.3.6.1.2.1.3.1.1.2'  # atPhysAddress in RFC1213MIB
         arp_oid_str = '1.3.6.1.2.1.4.22.1.2'  # ipNetToMediaPhysAddress in RFC1213MIB
 
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            self.community_data,
-            self.transport_target,
-            0, 20,
-            arp_oid_str,
-        )
-
-        arp_list = []
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
-            else:
-                for varBindTableRow in var_bind_table:
-                    oid_value, mac_value = varBindTableRow[0]
-                    oid_str = oid_value.prettyPrint()
-                    oid_str_list = oid_str.split('.')
-                    if_index = oid_value._value[-5]
-                    if not oid_str.startswith(arp_oid_str):
-                        break
-                    ip_address = '.'.join(oid_str_list[-4:])
-                    ss = struct.unpack('!6B', mac_value._value)
-                    mac_address = ':'.join(map('{:02x}'.format, ss))
-                    arp_list.append((ip_address, mac_address, if_index))
-
-        return arp_list
+        for index, (mac_value,) in self._iter_arp_rows(arp_oid_str, if_index_list):
+            if_index, ip_address = ARP_INDEX.decode(index)
+            ss = struct.unpack('!6B', bytes(mac_value))
+            mac_address = ':'.join(map('{:02x}'.format, ss))
+            yield int_to_ip(ip_address), mac_address, if_index
 
+    @instrumented
     def get_cdp_info(self):
-        # Return the {if_index: {neighbor: neighbor, remote_port: remote_port}} of cdp info.
+        # Return the {if_index: [{neighbor, remote_port, address, capabilities}]} of cdp info.
+        # capabilities is cdpCacheCapabilities as an int, e.g. snmptable.CDP_SWITCH, None if not given.
         cdp_device_oid = '1.3.6.1.4.1.9.9.23.1.2.1.1.6'
         cdp_remote_if = '1.3.6.1.4.1.9.9.23.1.2.1.1.7'
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            self.community_data,
-            self.transport_target,
-            0, 20,
-            cdp_device_oid,  # cdp neighbor device id
-            cdp_remote_if,  # cdp remote interface name
-        )
+        cdp_address_type_oid = '1.3.6.1.4.1.9.9.23.1.2.1.1.3'
+        cdp_address_oid = '1.3.6.1.4.1.9.9.23.1.2.1.1.4'
+        cdp_capabilities_oid = '1.3.6.1.4.1.9.9.23.1.2.1.1.9'
 
         cdp_info = {}
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
+        try:
+            rows = self.walk_table([cdp_device_oid,  # cdp neighbor device id
+                                    cdp_remote_if,  # cdp remote interface name
+                                    cdp_address_type_oid,
+                                    cdp_address_oid,  # neighbor management address
+                                    cdp_capabilities_oid])
+        except SNMPError:
+            return cdp_info
+
+        for index, (neighbor, remote_port, address_type, address, capabilities) in rows:
+            if_index, _ = CDP_CACHE_INDEX.decode(index)
+            remote_port = remote_port.prettyPrint() if remote_port is not None else ''
+            neighbor = short_hostname(neighbor.prettyPrint())
+            if address_type is not None and int(address_type) == 1 and address is not None and \
+                    len(address._value) == 4:  # ip
+                address = '.'.join(map(str, bytearray(address._value)))
             else:
-                for varBindTableRow in var_bind_table:
-                    o0, neighbor = varBindTableRow[0]
-                    o1, remote_port = varBindTableRow[1]
-                    mib_tuple = o0._value
-                    if mib_tuple[:-2] != tuple([int(x) for x in cdp_device_oid.split('.')]):
-                        break
-                    if_index = mib_tuple[-2]
-                    remote_port = remote_port.prettyPrint().decode()
-                    neighbor = neighbor.prettyPrint().decode().split('.')[0].split('(')[0]
-                    if if_index not in cdp_info:
-                        cdp_info[if_index] = []
-                    cdp_info[if_index].append(dict(remote_port=remote_port,
-                                                   neighbor=neighbor))
+                address = ''
+            if if_index not in cdp_info:
+                cdp_info[if_index] = []
+            if capabilities is not None:
+                capabilities = int.from_bytes(bytes(capabilities), 'big')
+            cdp_info[if_index].append(dict(remote_port=remote_port,
+                                           neighbor=neighbor,
+                                           address=address,
+                                           capabilities=capabilities))
 
         return cdp_info
 
+    @instrumented
     def get_vlan_info(self):
         vlan_state_oid = '1.3.6.1.4.1.9.9.46.1.3.1.1.2'  # vtpVlanState
         vlan_type_oid = '1.3.6.1.4.1.9.9.46.1.3.1.1.3'  # vtpVlanType
         vlan_name_oid = '1.3.6.1.4.1.9.9.46.1.3.1.1.4'  # vtpVlanName
-        cmd_gen = self.cmd_gen
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            self.community_data,
-            self.transport_target,
-            0, 30,
-            vlan_state_oid,
-            vlan_type_oid,
-            vlan_name_oid
-        )
 
         vlan_dict = {}
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
-            else:
-                for varBindTableRow in var_bind_table:
-                    o0, vlan_state = varBindTableRow[0]
-                    o1, vlan_type = varBindTableRow[1]
-                    o2, vlan_name = varBindTableRow[2]
-                    mib_tuple = o0._value
-                    if mib_tuple[:-2] != tuple([int(x) for x in vlan_state_oid.split('.')]):
-                        break
-                    if vlan_state._value != 1:
-                        continue
-                    if vlan_type._value != 1:
-                        continue
-                    vlan_index = mib_tuple[-1]
-                    vlan_dict[vlan_index] = dict(state=vlan_state._value,
-                                                 type=vlan_type._value,
-                                                 name=vlan_name._value)
+        for index, (vlan_state, vlan_type, vlan_name) in self.walk_table([vlan_state_oid,
+                                                                         vlan_type_oid,
+                                                                         vlan_name_oid]):
+            if vlan_state._value != 1:
+                continue
+            if vlan_type is None or vlan_type._value != 1:
+                continue
+            _, vlan_index = VTP_VLAN_INDEX.decode(index)
+            vlan_dict[vlan_index] = dict(state=vlan_state._value,
+                                         type=vlan_type._value,
+                                         name=vlan_name.prettyPrint() if vlan_name is not None else '')
         return vlan_dict
 
-    def get_mac_if_info(self, vlan='1'):
+    def forget_bridge_ports(self):
+        # Drop the cached dot1dBasePort -> ifIndex map after the interfaces changed.
+        with self._bridge_port_lock:
+            self._bridge_port_map.clear()
+            self._vlan_bridge_port_maps.clear()
+
+    @instrumented
+    def get_bridge_port_map(self, vlan=None):
         bridge_if_index_oid = '1.3.6.1.2.1.17.1.4.1.2'  # dot1dBasePortIfIndex
+
+        bridge_if_index_dict = {}
+        for index, (if_index,) in self.walk_table([bridge_if_index_oid], context=vlan, lean=self.lean):
+            bridge_if_index_dict[index[0]] = int(if_index)
+        return bridge_if_index_dict
+
+    def bridge_port_if_index(self, bridge_number, vlan=None):
+        # ifIndex of one dot1dBasePort, walking dot1dBasePortIfIndex only when the cached map lacks it.
+        return self._resolve_bridge_ports(vlan, {bridge_number}).get(bridge_number)
+
+    def cached_bridge_port_if_index(self, bridge_number, vlan=None):
+        # ifIndex of one dot1dBasePort from the cached maps only, None when they lack it.
+        with self._bridge_port_lock:
+            return self._vlan_bridge_port_maps.get(_vlan_key(vlan), self._bridge_port_map).get(bridge_number)
+
+    def _resolve_bridge_ports(self, vlan, bridge_numbers):
+        # Bridge port numbers map to the same ifIndex in every VLAN context, so a
+        # VLAN's own dot1dBasePortIfIndex is only walked when the cached map
+        # lacks some of its ports. A VLAN whose map disagrees keeps its own map,
+        # cached apart from the shared one.
+        with self._bridge_port_lock:
+            bridge_port_map = self._vlan_bridge_port_maps.get(_vlan_key(vlan), self._bridge_port_map)
+            if bridge_numbers.issubset(bridge_port_map):
+                return bridge_port_map
+
+        vlan_map = self.get_bridge_port_map(vlan)
+        with self._bridge_port_lock:
+            for bridge_number, if_index in vlan_map.items():
+                if self._bridge_port_map.get(bridge_number, if_index) != if_index:
+                    logger.warning('%s: bridge port %s maps to ifIndex %s in Vlan%s, cached %s' % (
+                        self.ip, bridge_number, if_index, vlan, self._bridge_port_map[bridge_number]))
+                    self._vlan_bridge_port_maps[_vlan_key(vlan)] = vlan_map
+                    return vlan_map
+            self._vlan_bridge_port_maps.pop(_vlan_key(vlan), None)
+            self._bridge_port_map.update(vlan_map)
+            return self._bridge_port_map
+
+    @instrumented
+    def get_mac_if_info(self, vlan='1'):
+        return list(self.iter_mac_if_info(vlan))
+
+    def iter_mac_if_info(self, vlan='1'):
+        # Yield (mac, if_index) rows as the walk goes.
+        for mac, if_index in self.iter_fdb(vlan):
+            yield int_to_mac(mac), if_index
+
+    def iter_fdb(self, vlan='1'):
+        # Yield raw (mac, if_index) rows, mac as a 48-bit int, resolving bridge ports from the
+        # cached map and walking this VLAN's map at most once.
         index_bridge_oid = '1.3.6.1.2.1.17.4.3.1.2'  # dot1dTpFdbPort
-        cmd_gen = self.cmd_gen
 
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            cmdgen.CommunityData('%s@%s' % (self.community, vlan)),
-            self.transport_target,
-            0, 30,
-            bridge_if_index_oid
-        )
+        with self._bridge_port_lock:
+            bridge_if_index_dict = self._vlan_bridge_port_maps.get(_vlan_key(vlan), self._bridge_port_map)
+        resolved = False
+        for index, (bridge_number,) in self.iter_table([index_bridge_oid], context=vlan, lean=self.lean):
+            bridge_number = int(bridge_number)
+            if bridge_number not in bridge_if_index_dict and not resolved:
+                bridge_if_index_dict = self._resolve_bridge_ports(vlan, {bridge_number})
+                resolved = True
+            yield FDB_INDEX.decode(index)[0], bridge_if_index_dict.get(bridge_number, 0)
 
-        bridge_if_index_dict = {}
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
-            else:
-                for varBindTableRow in var_bind_table:
-                    o0, if_index = varBindTableRow[0]
-                    mib_tuple = o0._value
-                    if mib_tuple[:-1] != tuple([int(x) for x in bridge_if_index_oid.split('.')]):
-                        break
-                    bridge_number = mib_tuple[-1]
-                    bridge_if_index_dict[bridge_number] = if_index._value
-
-        error_indication, error_interface_types, error_index, var_bind_table = cmd_gen.bulkCmd(
-            cmdgen.CommunityData('%s@%s' % (self.community, vlan)),
-            self.transport_target,
-            0, 30,
-            index_bridge_oid
-        )
-
-        mac_list = []
-        if error_indication:
-            logger.error('%s: %s' % (error_indication, self.ip))
-            raise Exception(error_indication)
-        else:
-            if error_interface_types:
-                logger.error('%s: %s at %s' % (
-                    self.ip,
-                    error_interface_types.prettyPrint(),
-                    error_index and var_bind_table[-1][int(error_index) - 1] or '?'
-                ))
+    def get_qbridge_fdb_vlans(self):
+        # {dot1qFdbId: vlan} from dot1qVlanFdbId; with shared learning the lowest VLAN of an FDB stands for it.
+        vlan_fdb_id_oid = '1.3.6.1.2.1.17.7.1.4.2.1.3'  # dot1qVlanFdbId
+
+        fdb_vlans = {}
+        for index, (fdb_id,) in self.iter_table([vlan_fdb_id_oid]):
+            vlan_id = QBRIDGE_VLAN_INDEX.decode(index)[1]
+            fdb_id = int(fdb_id)
+            fdb_vlans[fdb_id] = min(vlan_id, fdb_vlans.get(fdb_id, vlan_id))
+        return fdb_vlans
+
+    @instrumented
+    def get_qbridge_fdb(self):
+        # Return {vlan: [(mac, if_index)]} from one dot1qTpFdbTable walk, None if the device has no
+        # Q-BRIDGE-MIB, i.e. no dot1qVlanFdbId; an empty FDB gives {}, a timeout raises SNMPError.
+        # The table is indexed by FDB id, mapped to VLANs by get_qbridge_fdb_vlans(); an FDB id
+        # missing from that map is taken for the VLAN id, as on Cisco.
+        fdb_port_oid = '1.3.6.1.2.1.17.7.1.2.2.1.2'  # dot1qTpFdbPort
+        fdb_status_oid = '1.3.6.1.2.1.17.7.1.2.2.1.3'  # dot1qTpFdbStatus
+
+        fdb_vlans = self.get_qbridge_fdb_vlans()
+        if not fdb_vlans:
+            return None
+
+        indexes = []
+        bridge_numbers = []
+        for index, (bridge_number, status) in self.iter_table([fdb_port_oid, fdb_status_oid], lean=self.lean):
+            if status is not None and int(status) == 2:  # invalid
+                continue
+            indexes.append(index)
+            bridge_numbers.append(int(bridge_number))
+        if not indexes:
+            return {}
+
+        bridge_if_index_dict = self._resolve_bridge_ports(None, set(bridge_numbers))
+        columns = QBRIDGE_FDB_INDEX.decode_columns(indexes)
+
+        fdb_dict = {}
+        for fdb_id, mac, bridge_number in zip(columns['fdb_id'], columns['mac'], bridge_numbers):
+            vlan_id = fdb_vlans.get(fdb_id, fdb_id)
+            fdb_dict.setdefault(vlan_id, []).append((mac, bridge_if_index_dict.get(bridge_number, 0)))
+        return fdb_dict
+
+    @instrumented
+    def get_qbridge_mac_if_info(self):
+        fdb_dict = self.get_qbridge_fdb()
+        if fdb_dict is None:
+            return None
+        return dict((vlan_id, _format_fdb(fdb_list)) for vlan_id, fdb_list in fdb_dict.items())
+
+    @instrumented
+    def get_all_fdb(self, vlans=None, concurrency=4, qbridge=None):
+        """Return {vlan: [(mac, if_index)]} with 48-bit int MACs for all (or the given) VLANs.
+
+        With qbridge None the single Q-BRIDGE-MIB walk is tried first and devices
+        without it fall back to per-VLAN BRIDGE-MIB walks, remembered per device;
+        a timeout or an empty FDB does not count as a device without it.
+        The Q-BRIDGE walk returns every VLAN of the device whatever `vlans` says,
+        as the VTP VLAN list callers pass is empty on switches without VTP, plus
+        an empty list for each of `vlans` without learnt MACs.
+        Per-VLAN walks run up to `concurrency` VLAN contexts at once.
+        """
+        key = (self.ip, self.port)
+        if qbridge is None:
+            qbridge = device_qbridge_support.get(key) is not False
+        if qbridge:
+            fdb_dict = self.get_qbridge_fdb()
+            device_qbridge_support[key] = fdb_dict is not None
+            if fdb_dict is not None:
+                for vlan_id in vlans or ():
+                    fdb_dict.setdefault(int(vlan_id), [])
+                return fdb_dict
+            logger.info('%s: no Q-BRIDGE-MIB dot1qVlanFdbId, walking BRIDGE-MIB per VLAN' % self.ip)
+
+        if vlans is None:
+            vlans = list(self.get_vlan_info())
+        if not vlans:
+            return {}
+
+        # Seed the bridge port map once so the concurrent walks can reuse it.
+        if not self._bridge_port_map:
+            bridge_port_map = self.get_bridge_port_map(vlans[0])
+            with self._bridge_port_lock:
+                self._bridge_port_map.update(bridge_port_map)
+
+        # `concurrency` workers on the shared walk threads take VLANs off one list.
+        pending = list(reversed(vlans))
+        fdb_dict = {}
+
+        method = current_method()
+
+        def walk_vlans():
+            set_current_method(method)
+            try:
+                while True:
+                    try:
+                        vlan_id = pending.pop()
+                    except IndexError:
+                        return
+                    fdb_dict[vlan_id] = list(self.iter_fdb(vlan_id))
+            finally:
+                set_current_method(None)
+
+        futures = [walk_executor().submit(walk_vlans) for _ in range(min(concurrency, len(vlans)))]
+        for future in futures:
+            future.result()
+        return dict((vlan_id, fdb_dict[vlan_id]) for vlan_id in vlans)
+
+    @instrumented
+    def get_all_mac_if_info(self, vlans=None, concurrency=4, qbridge=None):
+        # Return {vlan: [(mac, if_index)]}, see get_all_fdb().
+        fdb_dict = self.get_all_fdb(vlans, concurrency=concurrency, qbridge=qbridge)
+        return dict((vlan_id, _format_fdb(fdb_list)) for vlan_id, fdb_list in fdb_dict.items())
+
+    def _iter_arp_rows(self, arp_oid_str, if_index_list):
+        # The whole column, or one subtree walk per interface; the ARP table is indexed by ifIndex first.
+        if if_index_list is None:
+            for row in self.iter_table([arp_oid_str], lean=self.lean):
+                yield row
+            return
+        for if_index in if_index_list:
+            for index, values in self.iter_table(['%s.%d' % (arp_oid_str, if_index)], lean=self.lean):
+                yield (if_index,) + tuple(index), values
+
+    @instrumented
+    def get_arp_table(self, if_index_list=None):
+        # get_arp() as an ArpTable, built from the OID index without formatting strings.
+        arp_oid_str = '1.3.6.1.2.1.4.22.1.2'  # ipNetToMediaPhysAddress in RFC1213MIB
+
+        indexes = []
+        macs = array.array('Q')
+        for index, (mac_value,) in self._iter_arp_rows(arp_oid_str, if_index_list):
+            indexes.append(index)
+            macs.append(int.from_bytes(bytes(mac_value), 'big'))
+        columns = ARP_INDEX.decode_columns(indexes)
+        return ArpTable(ip=columns['ip'], mac=macs, if_index=columns['if_index'])
+
+    @instrumented
+    def get_mac_table(self, vlans=None, concurrency=4, qbridge=None):
+        # get_all_mac_if_info() as one MacTable for every VLAN.
+        mac_table = MacTable()
+        for vlan_id, fdb_list in self.get_all_fdb(vlans, concurrency=concurrency, qbridge=qbridge).items():
+            vlan_id = int(vlan_id)
+            for mac, if_index in fdb_list:
+                mac_table.append(vlan_id, mac, if_index)
+        return mac_table
+
+
+def _format_fdb(fdb_list):
+    return [(int_to_mac(mac), if_index) for mac, if_index in fdb_list]
+
+
+def device_poller(host, community, timeout=5, retries=1, gateway=False, access_switch=True):
+    key = (host, community, gateway, access_switch)
+    with _device_pollers_lock:
+        poller = device_pollers.get(key)
+        if poller is None:
+            tables = ['if_index']
+            if gateway:
+                tables.append('if_ip')
+            if access_switch:
+                tables += ['cdp_info', 'vlan_info']
+            snmp_helper = SNMPHelper(host, community, timeout=timeout, retries=retries)
+            poller = device_pollers[key] = IncrementalPoller(snmp_helper, tables)
+    return poller
+
+
+def collect_device(host, community, timeout=5, retries=1, gateway=False, access_switch=True, vlan_concurrency=4,
+                   incremental=False):
+    """Return the same tables test() prints for one device as a plain dict.
+
+    With incremental, if_index, if_ip, cdp_info and vlan_info come from the
+    host's IncrementalPoller, which keeps them between calls and re-walks
+    only what changed; device['changes'] then holds the deltas of this poll.
+    """
+    if incremental:
+        poller = device_poller(host, community, timeout, retries, gateway, access_switch)
+        changes = poller.poll()
+        snmp_helper = poller.snmp_helper
+        device = dict(host=host,
+                      hostname=snmp_helper.get_hostname(),
+                      facts=poller.facts,
+                      changes=changes)
+        device.update(poller.tables)
+    else:
+        snmp_helper = SNMPHelper(host, community, timeout=timeout, retries=retries)
+        device = dict(host=host,
+                      hostname=snmp_helper.get_hostname(),
+                      facts=snmp_helper.get_device_facts(),
+                      if_index=snmp_helper.get_if_index())
+        if gateway:
+            device['if_ip'] = snmp_helper.get_if_ip()
+        if access_switch:
+            device['cdp_info'] = snmp_helper.get_cdp_info()
+            device['vlan_info'] = snmp_helper.get_vlan_info()
+
+    if access_switch:
+        device['arp'] = snmp_helper.get_arp()
+        device['mac_if_info'] = snmp_helper.get_all_mac_if_info(list(device.get('vlan_info', {})),
+                                                                concurrency=vlan_concurrency)
+
+    return device
+
+
+def vlan_subnets(if_index_dict, if_ip):
+    # {if_index: [network/mask]} of the Vlan interfaces in get_if_ip() output, the subnets swept to warm ARP.
+    subnets = {}
+    for if_index, addresses in if_ip.items():
+        if not (if_index_dict.get(if_index) or '').startswith('Vlan'):
+            continue
+        for ip, mask in addresses:
+            ip_net = IPNetwork('%s/%s' % (ip, mask))
+            subnet = '%s/%s' % (ip_net.network, ip_net.netmask)
+            if subnet not in subnets.get(if_index, ()):
+                subnets.setdefault(if_index, []).append(subnet)
+    return subnets
+
+
+def ping_sweep(subnet, timeout=1.0):
+    # Ping every host of subnet so the gateway ARPs for them; returns pingscan.sweep() results.
+    results = pingscan.sweep([subnet], timeout=timeout)
+    logger.info('Swept %s: %d of %d hosts answered', subnet, sum(x is not None for x in results.values()),
+                len(results))
+    return results
+
+
+async def harvest_gateway_async(device, community, timeout, retries, claimed, semaphore, executor=None,
+                                settle=ARP_SETTLE, sweep=ping_sweep):
+    """Sweep a gateway's VLAN subnets and walk each one's ARP once it has settled.
+
+    Every subnet not already in `claimed` (shared by the zone's gateways) is
+    swept, and `settle` seconds later, without holding a `semaphore` slot
+    in between, only its interface's ipNetToMediaTable subtree is walked.
+    Interfaces the gateway is HSRP standby on are left to the active peer.
+    Returns an ArpTable of the harvested interfaces.
+    """
+    loop = asyncio.get_running_loop()
+    host = device['host']
+    snmp_helper = SNMPHelper(host, community, timeout=timeout, retries=retries)
+
+    async with semaphore:
+        standby = set(await loop.run_in_executor(executor, snmp_helper.get_hsrp_standby_interfaces))
+
+    async def harvest(if_index, subnets):
+        for subnet in subnets:
+            try:
+                await loop.run_in_executor(executor, sweep, subnet)
+            except Exception as e:
+                logger.error('%s: sweep of %s failed: %s' % (host, subnet, e))
+        await asyncio.sleep(settle)
+        async with semaphore:
+            return await loop.run_in_executor(executor, snmp_helper.get_arp_table, [if_index])
+
+    tasks = []
+    for if_index, subnets in sorted(vlan_subnets(device.get('if_index', {}), device.get('if_ip', {})).items()):
+        subnets = [x for x in subnets if x not in claimed]
+        if if_index in standby or not subnets:
+            continue
+        claimed.update(subnets)
+        tasks.append(harvest(if_index, subnets))
+    return merge_arp(await asyncio.gather(*tasks))
+
+
+async def collect_zone_async(value_zone, community, timeout=5, retries=1, concurrency=32, executor=None,
+                             incremental=False, sweep_settle=None):
+    # Collect every gateway and access switch of one zone, at most `concurrency` devices at a time.
+    # With sweep_settle, each gateway's ARP comes from harvest_gateway_async(), overlapping the other walks.
+    zone = value_zone.get("zone", "")
+    gateway_list = value_zone['gateway']
+    access_switch_list = value_zone['access_switch']
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    claimed = set()
+
+    async def collect(host):
+        async with semaphore:
+            s = time.time()
+            try:
+                device = await loop.run_in_executor(executor, collect_device,
+                                                    host, community, timeout, retries,
+                                                    host in gateway_list,
+                                                    host in access_switch_list,
+                                                    4, incremental)
+            except Exception as e:
+                logger.error('%s: collection failed in zone %s: %s' % (host, zone, e))
+                device = dict(host=host, error=str(e))
+
+        if sweep_settle is not None and host in gateway_list and 'error' not in device:
+            try:
+                arp_table = await harvest_gateway_async(device, community, timeout, retries, claimed, semaphore,
+                                                        executor=executor, settle=sweep_settle)
+                if 'arp' in device:
+                    arp_table = merge_arp([arp_table, ArpTable.from_rows(device['arp'])])
+                # get_arp() rows, like every other device's 'arp'.
+                device['arp'] = list(arp_table)
+            except Exception as e:
+                logger.error('%s: ARP harvest failed in zone %s: %s' % (host, zone, e))
+        logger.info("Collected %s in %.2fs", host, time.time() - s)
+        return host, device
+
+    # A host listed both as gateway and access switch is only walked once.
+    hosts = list(dict.fromkeys(gateway_list + access_switch_list))
+    results = await asyncio.gather(*[collect(host) for host in hosts])
+    return dict(results)
+
+
+async def collect_fleet_async(configs, concurrency=32, max_workers=None, incremental=False, sweep_settle=None,
+                              executor=None):
+    # Collect all zones of config.json concurrently, each zone bounded by its own limit.
+    # Devices are walked on `executor`, by default the process-wide fleet_executor(max_workers).
+    community = configs['snmp']['community']
+    retries = configs['snmp']['retries']
+    timeout = configs['snmp']['timeout']
+    zones = configs['host']
+
+    if executor is None:
+        if max_workers is None:
+            max_workers = concurrency * max(len(zones), 1)
+        executor = fleet_executor(max_workers)
+
+    results = await asyncio.gather(*[
+        collect_zone_async(value_zone, community, timeout=timeout, retries=retries,
+                           concurrency=concurrency, executor=executor, incremental=incremental,
+                           sweep_settle=sweep_settle)
+        for value_zone in zones
+    ])
+
+    fleet = {}
+    for value_zone, devices in zip(zones, results):
+        fleet.setdefault(value_zone.get("zone", ""), {}).update(devices)
+    return fleet
+
+
+def collect_fleet(configs, concurrency=32, max_workers=None, incremental=False, sweep_settle=None, executor=None):
+    return asyncio.run(collect_fleet_async(configs, concurrency=concurrency, max_workers=max_workers,
+                                           incremental=incremental, sweep_settle=sweep_settle, executor=executor))
+
+
+def compact_device(device):
+    # Swap the row lists of collect_device() output for array-backed tables, which pickle as a few byte strings.
+    if 'arp' in device:
+        device['arp'] = ArpTable.from_rows(device['arp'])
+    if 'mac_if_info' in device:
+        device['mac_if_info'] = MacTable.from_mac_if_info(device['mac_if_info'])
+    return device
+
+
+def shard_configs(configs, shards):
+    # Deal the hosts of every zone round-robin into `shards` configs with the same layout.
+    hosts = []
+    for value_zone in configs['host']:
+        hosts.extend(dict.fromkeys(value_zone['gateway'] + value_zone['access_switch']))
+    assignment = dict((host, i % shards) for i, host in enumerate(hosts))
+
+    result = []
+    for shard in range(shards):
+        zones = []
+        for value_zone in configs['host']:
+            zone = dict(value_zone,
+                        gateway=[x for x in value_zone['gateway'] if assignment[x] == shard],
+                        access_switch=[x for x in value_zone['access_switch'] if assignment[x] == shard])
+            if zone['gateway'] or zone['access_switch']:
+                zones.append(zone)
+        if zones:
+            result.append(dict(configs, host=zones))
+    return result
+
+
+def _collect_shard(configs, concurrency, sweep_settle=None):
+    fleet = collect_fleet(configs, concurrency=concurrency, sweep_settle=sweep_settle)
+    for devices in fleet.values():
+        for device in devices.values():
+            compact_device(device)
+    return fleet
+
+
+def collect_fleet_sharded(configs, processes=None, concurrency=32, sweep_settle=None):
+    """collect_fleet() split across a process pool, for fleets one interpreter cannot keep up with.
+
+    Each worker process collects its share of the hosts with
+    collect_fleet() and sends back ARP and MAC tables as ArpTable/MacTable.
+    Workers are spawned rather than forked so they do not inherit the
+    parent's walk threads and pysnmp engines. sweep_settle is passed on to
+    every worker's collect_fleet(); gateways of one zone in different
+    shards do not share their claimed subnets, so an HSRP pair split across
+    shards may both sweep a subnet.
+    """
+    processes = processes or os.cpu_count() or 1
+    shards = shard_configs(configs, processes)
+    fleet = {}
+    if not shards:
+        return fleet
+
+    with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context('spawn')) as executor:
+        for shard_fleet in executor.map(_collect_shard, shards, [concurrency] * len(shards),
+                                        [sweep_settle] * len(shards)):
+            for zone, devices in shard_fleet.items():
+                fleet.setdefault(zone, {}).update(devices)
+    return fleet
+
+
+def test_async(concurrency=32, processes=None, db_path=None, sweep_settle=None):
+    # With db_path the fleet is written to a SnapshotStore instead of printed.
+    # With sweep_settle the gateways' VLAN subnets are swept and their ARP harvested, see harvest_gateway_async().
+    with open('config.json') as f:
+        configs = json.load(f)
+
+    logger.info('Start MAC monitoring (async)')
+    s = time.time()
+    if processes:
+        fleet = collect_fleet_sharded(configs, processes=processes, concurrency=concurrency,
+                                      sweep_settle=sweep_settle)
+    else:
+        fleet = collect_fleet(configs, concurrency=concurrency, sweep_settle=sweep_settle)
+    if db_path:
+        store = SnapshotStore(db_path)
+        cycle_id = store.write_fleet(fleet, started=s)
+        store.close()
+        logger.info('Stored cycle %d in %s', cycle_id, db_path)
+        print(time.time() - s)
+        return
+    for zone, devices in fleet.items():
+        for host, device in devices.items():
+            if 'error' in device:
+                print(zone, host, 'ERROR', device['error'])
+                continue
+            mac_if_info = device.get('mac_if_info', {})
+            if isinstance(mac_if_info, MacTable):
+                mac_count = len(mac_if_info)
             else:
-                for varBindTableRow in var_bind_table:
-                    o0, bridge_number = varBindTableRow[0]
-                    mib_tuple = o0._value
-                    if mib_tuple[:-6] != tuple([int(x) for x in index_bridge_oid.split('.')]):
-                        break
-                    if_index = bridge_if_index_dict.get(bridge_number._value, 0)
-                    mac_address = ':'.join(map('{:02x}'.format, mib_tuple[-6:]))
-                    mac_list.append((mac_address, if_index))
-        return mac_list
+                mac_count = sum(len(x) for x in mac_if_info.values())
+            print(zone, host, device['hostname'],
+                  'ARP Count:', len(device.get('arp', [])),
+                  'MAC Count:', mac_count)
+    print(time.time() - s)
+    logger.info("Done.")
 
 
 def test():
@@ -415,25 +1151,20 @@ def test():
             device_dict[host] = dict(snmp_helper=snmp_helper,
                                      if_index_dict=if_index_dict)
 
-            if_ip_list = snmp_helper.get_if_ip()  # if_index: if_name
+            if_ip_dict = snmp_helper.get_if_ip()  # if_index: [(ip, mask)]
             logger.info("Got interface ip for switch %s", host)
-            print(json.dumps(if_ip_list, indent=2))
-            subnets = []
-            for ip, mask, if_index, if_desc in if_ip_list:
-                if if_index_dict.get(if_index).startswith('Vlan'):
-                    ip_net = IPNetwork('%s/%s' % (ip, mask))
-                    subnets.append('%s/%s' % (ip_net.network, ip_net.netmask))
-
-            subnets = list(set(subnets))
-            ping_socket = pingscan.get_ping_socket()
+            print(json.dumps(if_ip_dict, indent=2))
+            subnets = set(x for subnets in vlan_subnets(if_index_dict, if_ip_dict).values() for x in subnets)
+
             for subnet in subnets:
-                pingscan.ping_net(subnet, ping_socket)
+                ping_sweep(subnet)
                 time.sleep(0.5)
         
         for host in access_switch_list:
             if host in device_dict:
                 snmp_helper = device_dict[host]['snmp_helper']
                 if_index_dict = device_dict[host]['if_index_dict']
+                hostname = snmp_helper.get_hostname()
             else:
                 snmp_helper = SNMPHelper(host, community, timeout=timeout, retries=retries)
                 hostname = snmp_helper.get_hostname()
@@ -460,8 +1191,9 @@ def test():
             vlans = list(vlan_dict.keys())
             # print json.dumps(vlan_dict, indent=2)
 
+            mac_if_info = snmp_helper.get_all_mac_if_info(vlans)
             for vlan_id in vlans:
-                mac_ifindex_list = snmp_helper.get_mac_if_info(vlan_id)
+                mac_ifindex_list = mac_if_info[vlan_id]
                 logger.info("Got MAC table for Vlan%s@%s", vlan_id, hostname)
                 for mac_address, if_index in mac_ifindex_list:
                     if_name = if_index_dict.get(if_index)
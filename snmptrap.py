@@ -0,0 +1,212 @@
+import logging
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+import berdecode
+from snmptable import int_to_mac, mac_to_int
+
+logger = logging.getLogger("ICBC")
+
+SNMP_TRAP_OID = (1, 3, 6, 1, 6, 3, 1, 1, 4, 1, 0)  # snmpTrapOID.0
+LINK_DOWN = (1, 3, 6, 1, 6, 3, 1, 1, 5, 3)
+LINK_UP = (1, 3, 6, 1, 6, 3, 1, 1, 5, 4)
+IF_INDEX_OID = (1, 3, 6, 1, 2, 1, 2, 2, 1, 1)  # ifIndex, a varbind of linkUp/linkDown
+MAC_CHANGED_NOTIFICATION = (1, 3, 6, 1, 4, 1, 9, 9, 215, 2, 0, 1)  # cmnMacChangedNotification
+HIST_MAC_CHANGED_MSG_OID = (1, 3, 6, 1, 4, 1, 9, 9, 215, 1, 1, 8, 1, 2)  # cmnHistMacChangedMsg
+
+# cmnHistMacChangedMsg packs 11-octet records: operation, VLAN (2 octets), MAC (6 octets) and
+# dot1dBasePort (2 octets); operation 0 ends the message.
+MAC_RECORD = struct.Struct('!BH6sH')
+MAC_LEARNT = 1
+MAC_REMOVED = 2
+
+
+def decode_mac_changed_msg(msg):
+    # [(operation, vlan, mac_int48, bridge_port)] of one cmnHistMacChangedMsg.
+    records = []
+    for pos in range(0, len(msg) - MAC_RECORD.size + 1, MAC_RECORD.size):
+        operation, vlan_id, mac, bridge_port = MAC_RECORD.unpack_from(msg, pos)
+        if operation == 0:
+            break
+        records.append((operation, vlan_id, int.from_bytes(mac, 'big'), bridge_port))
+    return records
+
+
+def encode_mac_changed_msg(records):
+    return b''.join(MAC_RECORD.pack(operation, vlan_id, mac.to_bytes(6, 'big'), bridge_port)
+                    for operation, vlan_id, mac, bridge_port in records) + b'\x00'
+
+
+def parse_trap(var_binds):
+    """Turn the varbinds of one trap into MAC/port events.
+
+    Returns [(event, fields)]: ('learnt' | 'removed', (vlan, mac, bridge_port))
+    for each cmnHistMacChangedMsg record and ('link_down' | 'link_up',
+    (if_index,)) for IF-MIB link traps. Other traps give no events.
+    """
+    trap_oid = None
+    for oid, value in var_binds:
+        if oid == SNMP_TRAP_OID:
+            trap_oid = value
+            break
+
+    events = []
+    if trap_oid == MAC_CHANGED_NOTIFICATION:
+        for oid, value in var_binds:
+            if oid[:len(HIST_MAC_CHANGED_MSG_OID)] == HIST_MAC_CHANGED_MSG_OID and isinstance(value, bytes):
+                for operation, vlan_id, mac, bridge_port in decode_mac_changed_msg(value):
+                    event = 'learnt' if operation == MAC_LEARNT else 'removed' if operation == MAC_REMOVED else None
+                    if event:
+                        events.append((event, (vlan_id, mac, bridge_port)))
+    elif trap_oid in (LINK_DOWN, LINK_UP):
+        for oid, value in var_binds:
+            if oid[:len(IF_INDEX_OID)] == IF_INDEX_OID:
+                events.append(('link_down' if trap_oid == LINK_DOWN else 'link_up', (value,)))
+    return events
+
+
+class TrapListener(object):
+    """UDP receiver applying MAC notification and link traps to a LocatorIndex.
+
+    Switches send CISCO-MAC-NOTIFICATION-MIB cmnMacChangedNotification and
+    IF-MIB linkUp/linkDown as SNMPv2c traps; each learnt MAC goes to
+    locator.learn_mac(), each removed one to forget_mac() and a link going
+    down clears its port with forget_port(), seconds after the change
+    instead of at the next FDB walk. The trap's source address is the host.
+    resolve_port(host, vlan, bridge_port) maps dot1dBasePort to ifIndex and
+    runs on the listener's one thread, so it should answer from a cache
+    (SNMPHelper.cached_bridge_port_if_index, Collector.resolve_port); learnt
+    MACs it gives no ifIndex for are dropped.
+    `lock` guards the locator when it is updated from other threads too, and
+    on_event(host, event, fields) is called for every applied event.
+    """
+
+    def __init__(self, locator, resolve_port=None, community=None, host='0.0.0.0', port=162, lock=None,
+                 on_event=None):
+        self.locator = locator
+        self.resolve_port = resolve_port
+        self.community = community.encode() if isinstance(community, str) else community
+        self.lock = lock or threading.Lock()
+        self.on_event = on_event
+        self.traps = 0
+        self.events = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.host, self.port = self.sock.getsockname()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self._running:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _serve(self):
+        while self._running:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except OSError:
+                break
+            try:
+                self.handle(data, address[0])
+            except Exception as e:
+                logger.error('trap listener: bad trap from %s: %s' % (address[0], e))
+
+    def handle(self, data, host):
+        # Decode and apply one trap datagram from host; returns the events applied.
+        community, _, var_binds = berdecode.decode_trap(data)
+        if self.community is not None and community != self.community:
+            logger.warning('trap listener: %s sent an unknown community', host)
+            return []
+        self.traps += 1
+
+        applied = []
+        for event, fields in parse_trap(var_binds):
+            if event == 'learnt':
+                vlan_id, mac, bridge_port = fields
+                if_index = self.resolve_port(host, vlan_id, bridge_port) if self.resolve_port else None
+                if if_index is None:
+                    logger.warning('%s: no ifIndex for bridge port %s, %s dropped', host, bridge_port,
+                                   int_to_mac(mac))
+                    continue
+                with self.lock:
+                    self.locator.learn_mac(host, vlan_id, mac, if_index)
+                fields = (vlan_id, mac, if_index)
+            elif event == 'removed':
+                vlan_id, mac, _ = fields
+                with self.lock:
+                    self.locator.forget_mac(host, vlan_id, mac)
+            elif event == 'link_down':
+                with self.lock:
+                    self.locator.forget_port(host, fields[0])
+            applied.append((event, fields))
+            if self.on_event is not None:
+                self.on_event(host, event, fields)
+
+        self.events += len(applied)
+        logger.debug('%s: trap with %d events', host, len(applied))
+        return applied
+
+
+def send_trap(host, trap_oid, var_binds=(), community='public', port=162, uptime=None):
+    # Send one SNMPv2c trap, for testing the listener without a switch.
+    if uptime is None:
+        uptime = int(time.monotonic() * 100) & 0xffffffff
+    data = berdecode.encode_trap(community, random.randint(1, 0x7fffffff), uptime, trap_oid, var_binds)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(data, (host, port))
+    finally:
+        sock.close()
+
+
+def send_mac_changed(host, records, community='public', port=162, history_index=1):
+    # records are (MAC_LEARNT | MAC_REMOVED, vlan, mac, bridge_port), mac as an int or any common notation.
+    records = [(operation, vlan_id, mac if isinstance(mac, int) else mac_to_int(mac), bridge_port)
+               for operation, vlan_id, mac, bridge_port in records]
+    send_trap(host, MAC_CHANGED_NOTIFICATION,
+              [(HIST_MAC_CHANGED_MSG_OID + (history_index,), encode_mac_changed_msg(records))],
+              community=community, port=port)
+
+
+def send_link(host, if_index, up, community='public', port=162):
+    send_trap(host, LINK_UP if up else LINK_DOWN,
+              [(IF_INDEX_OID + (if_index,), if_index),
+               ((1, 3, 6, 1, 2, 1, 2, 2, 1, 7, if_index), 1),  # ifAdminStatus
+               ((1, 3, 6, 1, 2, 1, 2, 2, 1, 8, if_index), 1 if up else 2)],  # ifOperStatus
+              community=community, port=port)
+
+
+if __name__ == '__main__':
+    from snmptable import LocatorIndex
+
+    logging.basicConfig(level=logging.INFO)
+
+    def print_event(host, event, fields):
+        if event in ('learnt', 'removed'):
+            print(host, event, 'Vlan%s' % fields[0], int_to_mac(fields[1]), *fields[2:])
+        else:
+            print(host, event, *fields)
+
+    # Without SNMP access the bridge port number stands in for the ifIndex.
+    trap_listener = TrapListener(LocatorIndex(), resolve_port=lambda host, vlan, bridge_port: bridge_port,
+                                 port=int(sys.argv[1]) if len(sys.argv) > 1 else 162, on_event=print_event)
+    logger.info('Listening for traps on %s:%d', trap_listener.host, trap_listener.port)
+    trap_listener.serve_forever()